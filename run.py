@@ -1,11 +1,30 @@
 import gspread
-from gspread_formatting import format_cell_range, CellFormat, TextFormat
+from gspread_formatting import format_cell_range, format_cell_ranges
+from gspread_formatting import CellFormat, TextFormat
 from gspread.exceptions import SpreadsheetNotFound, GSpreadException, APIError
 from google.oauth2.service_account import Credentials
-from datetime import datetime
+from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left
 import re
 import os
+import pickle
 import calendar
+import csv
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+import difflib
+import hashlib
+import json
+import math
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import mmap
+import sqlite3
+import struct
+import sys
+import threading
+import time
 from termcolor import colored, cprint
 
 
@@ -21,6 +40,10 @@ SCOPED_CREDS = CREDS.with_scopes(SCOPE)
 GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
 SHEET_NAME = 'Recurring Expense Tracker'
 MAX_COL_NUMBER = 50
+# the columns are recognised from this many rows at the top of the
+# worksheet, a column has to hold this share of dates, amounts or text
+SCHEMA_SAMPLE_ROWS = 50
+SCHEMA_MIN_SHARE = 0.8
 ROW_KEY = "row"
 TX_DATE_KEY = "tx_date"
 TX_MERCHANT_KEY = "tx_merchant"
@@ -30,6 +53,126 @@ ERROR_TOLERANCE = 0.1
 SUBS_DAY_FLEX = 4
 # in case the amount of the subscription various
 SUBS_AMOUNT_FLEX = 1
+# amounts are kept as integers in minor units, i.e. 10 ** CURRENCY_EXPONENT
+# of them make one unit of the currency (2: cents). Delete the ret_data
+# folder after changing it
+CURRENCY_EXPONENT = 2
+# the cadences subscriptions are paid in: name, length in days for
+# cadences of a fixed number of days, otherwise length in months
+SUBS_CADENCES = (
+    ("weekly", 7, 0),
+    ("bi-weekly", 14, 0),
+    ("monthly", 0, 1),
+    ("bi-monthly", 0, 2),
+    ("quarterly", 0, 3),
+    ("semi-annual", 0, 6),
+    ("yearly", 0, 12)
+    )
+# streams with fewer gaps between their payments get a lower confidence
+SUBS_CONFIDENT_GAPS = 3
+# streams with a lower confidence are not considered subscriptions
+SUBS_MIN_CONFIDENCE = 0.2
+# country codes card processors add to the merchant name. On their own
+# they can be part of the name ("toys r us"), so they are only dropped
+# next to a reference number or after one of the city names
+MERCHANT_LOCATION_CODES = r"(?:us|usa|gb|uk|de|fr|nl|se|ie|lu|ca|au)"
+MERCHANT_CITY_NAMES = (r"(?:london|manchester|dublin|paris|berlin|munich|"
+                       r"hamburg|amsterdam|stockholm|luxembourg|new york|"
+                       r"san francisco|seattle|toronto|sydney)")
+# merchant normalization, applied in this order to the lowercased name.
+# The store and the binary files keep the names they were saved with,
+# so delete the ret_data folder after changing the rules
+MERCHANT_RULES = (
+    # card processor and marketplace prefixes, e.g. "paypal *spotify"
+    (re.compile(r"^(?:paypal|sq|sp|sumup|iz|zettle|tst)\s*\*\s*"), ""),
+    (re.compile(r"^amzn\s*(?:mktp|mktplace|marketplace)\b.*"), "amazon"),
+    # a trailing '*' or '#' reference with a number, e.g. "netflix*ab12"
+    # or "target #1234". Other '*' and '#' only separate the words, so
+    # "google *youtube" stays apart from "google *gsuite"
+    (re.compile(r"\s*[*#]\s*\S*\d\S*$"), ""),
+    (re.compile(r"\s*[*#]\s*"), " "),
+    # web domains, e.g. "netflix.com"
+    (re.compile(r"\.(?:com|net|org|co\.uk|de|fr|nl|se|ie|io)\b"), ""),
+    # trailing reference numbers, e.g. "netflix 8472" or "uber 12ab34",
+    # with a location code on either side, e.g. "vodafone de 12345"
+    (re.compile(rf"(?:\s+{MERCHANT_LOCATION_CODES})?(?:\s+\S*\d\S*)+"
+                rf"(?:\s+{MERCHANT_LOCATION_CODES})?$"), ""),
+    # trailing location codes after a city, e.g. "starbucks london gb"
+    (re.compile(rf"(\s{MERCHANT_CITY_NAMES})\s+{MERCHANT_LOCATION_CODES}$"),
+     r"\1"),
+    (re.compile(r"\s+"), " "),
+    )
+# merchant names that are this similar are merged into one merchant
+# (share of the character trigrams of the shorter name)
+MERCHANT_CLUSTERING_ENABLED = True
+MERCHANT_CLUSTER_THRESHOLD = 0.7
+# shorter names are too ambiguous to be merged
+MERCHANT_CLUSTER_MIN_NGRAMS = 5
+# trigrams shared by more names than this don't suggest candidates
+MERCHANT_NGRAM_MAX_POSTINGS = 50
+# keyword,category rules for the spending category of each merchant
+CATEGORY_RULES_FILE = "merchant_categories.csv"
+# category of merchants no keyword matches
+CATEGORY_UNKNOWN = "other"
+# rolling windows (in months up to the end date) of the spend per merchant
+ROLLING_WINDOW_MONTHS = (3, 6, 12)
+# credits are matched to an earlier charge of the same merchant and amount
+# up to REFUND_MAX_DAYS before them, both are left out of the analysis
+REFUND_MAX_DAYS = 90
+# charges of the same merchant and amount (+- DUPLICATE_AMOUNT_FLEX) less
+# than DUPLICATE_MAX_DAYS apart are flagged as possible double charges
+DUPLICATE_MAX_DAYS = 3
+DUPLICATE_AMOUNT_FLEX = 0
+# number of months after the end date the upcoming charges are forecast
+FORECAST_MONTHS = 6
+# values compared by the parameter sweep
+SWEEP_DAY_FLEX_VALUES = (0, 1, 2, 3, 4, 5, 6, 7)
+SWEEP_AMOUNT_FLEX_VALUES = (0, 0.5, 1, 2, 5)
+# folder for the cleaned transaction data saved between runs
+TX_BINARY_DIR = "ret_data"
+# SQLite store keeping the cleaned transactions of every worksheet
+TX_STORE_FILE = os.path.join(TX_BINARY_DIR, "ret_transactions.db")
+TX_STORE_ENABLED = True
+# rejected rows are saved here if they can't be uploaded
+QUARANTINE_FILE = os.path.join(TX_BINARY_DIR, "quarantine.csv")
+# cache of analysis results, keyed by the hash of data and settings
+RESULT_CACHE_DIR = os.path.join(TX_BINARY_DIR, "results")
+RESULT_CACHE_MAX_BYTES = 200 * 1024 * 1024
+# change whenever the analysis changes so old results aren't reused
+RESULT_CACHE_VERSION = 9
+# the TxData attributes a cached result restores
+RESULT_CACHE_ATTRIBUTES = (
+    "sorted_clean_data", "refunds_data", "ANALYSIS_START_DATE",
+    "ANALYSIS_END_DATE", "subscriptions_data", "recurring_merchants_data",
+    "forecast_data"
+    )
+# merged merchant names (alias: canonical name) of every worksheet,
+# reused by later runs of the same worksheet
+MERCHANT_ALIAS_DIR = os.path.join(TX_BINARY_DIR, "aliases")
+# progress of running uploads, so interrupted uploads can be resumed
+UPLOAD_CHECKPOINT_DIR = os.path.join(TX_BINARY_DIR, "uploads")
+# datasets with at least this many transactions are analyzed in parallel
+ANALYSIS_PARALLEL_MIN_TX = 50000
+ANALYSIS_WORKERS = os.cpu_count() or 1
+# more shards than workers evens out merchants of very different sizes
+ANALYSIS_SHARDS_PER_WORKER = 4
+# results with more rows are split across several worksheets
+RESULTS_MAX_ROWS_PER_SHEET = 50000
+RESULTS_COLS = 12
+# the hash of the result is written to the last column of the first row
+RESULT_HASH_CELL = "L1"
+# heading, start date, end date, empty row and headings of each block
+RESULTS_HEADER_ROWS = 5
+# columns that identify a results row together with the merchant
+RESULTS_KEY_COLUMNS = ("subs_start_date", "first_tx_date")
+# rows per values write, keeps each request well below the payload limit
+RESULTS_WRITE_CHUNK_ROWS = 5000
+# Google Sheets limits
+SHEETS_MAX_CELLS = 10000000
+# day 0 of the serial numbers Sheets uses for dates
+SHEETS_EPOCH = datetime(1899, 12, 30)
+SHEETS_WRITES_PER_MINUTE = 60
+SHEETS_MAX_PARALLEL_WRITES = 4
 
 
 def intro_go_on():
@@ -355,13 +498,25 @@ def column_letter_to_number(column_letter):
         return False
 
 
-def import_raw_data(raw_data_wsheet):
+def column_number_to_letter(column_number):
     """
-    Import the raw transaction data from the worksheet
-    where the user imported his/her CSV file into a list of lists
-    Return: the list of lists with the raw transaction data
+    Convert a column number (1-based) to its spreadsheet column
+    letter (e.g. 1 -> 'A', 27 -> 'AA')
     """
+    column_letter = ""
+    while column_number > 0:
+        column_number, remainder = divmod(column_number - 1, 26)
+        column_letter = chr(ord('A') + remainder) + column_letter
 
+    return column_letter
+
+
+def get_columns_from_user():
+    """
+    Ask the user for the row where the transaction data starts and the
+    columns of the transaction date, merchant and amount
+    Return: start row, zero-based date, merchant and amount columns
+    """
     # let's start with the row where the transaction data starts
     input_message = "\nPlease enter the row number where the \
         \ntransaction data starts (e.g. 1, 2, 3, etc.):\n"
@@ -400,6 +555,38 @@ def import_raw_data(raw_data_wsheet):
     # we need to subtract 1 to get the zero-based index
     tx_amount_col -= 1
 
+    return start_row, tx_date_col, tx_merchant_col, tx_amount_col
+
+
+def import_raw_data(raw_data_wsheet):
+    """
+    Import the raw transaction data from the worksheet
+    where the user imported his/her CSV file into a list of lists
+    The columns are recognised from the first rows of the worksheet
+    (see infer_schema) and only asked for if the user doesn't confirm
+    them. Columns entered by the user are checked against the same
+    rows before the whole worksheet is downloaded
+    Return: the list of lists with the raw transaction data
+    """
+    sample_rows = get_sample_rows(raw_data_wsheet)
+    schema = infer_schema(sample_rows)
+    if schema and confirm_schema(schema, sample_rows):
+        start_row, tx_date_col, tx_merchant_col, tx_amount_col = schema
+
+    else:
+        columns_ok = False
+        while not columns_ok:
+            schema = get_columns_from_user()
+            problems = check_schema(schema, sample_rows)
+            columns_ok = True
+            if problems:
+                cprint("\n".join(problems), 'red')
+                again = input("\nDo you want to enter the row and \
+                              \ncolumns again? (y/n):\n")
+                columns_ok = again.strip().lower() != "y"
+
+        start_row, tx_date_col, tx_merchant_col, tx_amount_col = schema
+
     print(f"\nRET is now importing your raw transaction data \
           \nfrom the worksheet: {raw_data_wsheet.title}.")
     print("This may take a few seconds depending on the \
@@ -457,6 +644,23 @@ def convert_datetime_object_to_str(tx_date):
     return local_date
 
 
+def to_minor_units(amount):
+    """
+    Convert an amount in units of the currency (e.g. 9.99 or "9.99")
+    into an integer of minor units (999)
+    """
+    minor_units = Decimal(str(amount)).scaleb(CURRENCY_EXPONENT)
+    return int(minor_units.to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_minor_units(amount):
+    """
+    Convert an integer of minor units back into units of the currency.
+    Only used for the output, all calculations stay in minor units
+    """
+    return float(Decimal(amount).scaleb(-CURRENCY_EXPONENT))
+
+
 def format_row_in_worksheet(worksheet, row, type):
     """
     formatting a row in worksheet
@@ -476,24 +680,9 @@ def format_row_in_worksheet(worksheet, row, type):
                           CellFormat(textFormat=TextFormat(bold=False)))
 
 
-def append_and_format_row(ws_output, row_data, format_type):
-    """
-    Append a new row to the worksheet and format it
-    """
-    # Seems there is a bug in gspread when trying to a
-    # dd an empty row. Let's try this:
-    if not row_data or row_data == [""]:
-        row_data = ["-"]
-
-    ws_output.append_row(row_data)
-    # Get the row count after appending the new row
-    new_row_index = len(ws_output.get_all_values())
-    format_row_in_worksheet(ws_output, new_row_index, format_type)
-
-
-def append_dataset1_headings(ws_output):
+def get_dataset1_headings():
     """
-    Append the headings of the dataset to the worksheet
+    Return the headings of dataset1 (subscriptions)
     """
     keys_list = [
         TX_MERCHANT_KEY,
@@ -502,16 +691,18 @@ def append_dataset1_headings(ws_output):
         "subs_start_date",
         "subs_end_date",
         "subs_frequency",
+        "confidence",
         "subs_merchant_sum",
         "num_subs_tx",
-        "active"
+        "active",
+        "category"
         ]
-    append_and_format_row(ws_output, keys_list, "bold")
+    return keys_list
 
 
-def append_dataset2_headings(ws_output):
+def get_dataset2_headings():
     """
-    Append the headings of the dataset to the worksheet
+    Return the headings of dataset2 (recurring merchants)
     """
     keys_list = [
         TX_MERCHANT_KEY,
@@ -519,152 +710,731 @@ def append_dataset2_headings(ws_output):
         "first_tx_date",
         "last_tx_amount",
         "merchant_sum",
-        "num_tx"
+        "num_tx",
+        "category"
         ]
-    append_and_format_row(ws_output, keys_list, "bold")
+    return keys_list
 
 
-def append_sorted_headings(ws_output):
+def get_dataset1_rows(dataset):
     """
-    Append the headings of the dataset to the worksheet
+    Convert the rows of dataset1 into worksheet rows
     """
-    keys_list = [
-        TX_DATE_KEY,
-        TX_MERCHANT_KEY,
-        TX_AMOUNT_KEY,
-        ]
-    append_and_format_row(ws_output, keys_list, "bold")
-
-
-def append_dataset1_rows(ws_output, dataset):
-    """
-    Append the rows of dataset1 to the worksheet
-    """
-    for row in dataset:
-        ws_output.append_row([
+    return [
+        [
             row[TX_MERCHANT_KEY],
             row["subs_day"],
-            row[TX_AMOUNT_KEY],
+            from_minor_units(row[TX_AMOUNT_KEY]),
             convert_datetime_object_to_str(row["subs_start_date"]),
             convert_datetime_object_to_str(row["subs_end_date"]),
             row["subs_frequency"],
-            row["subs_merchant_sum"],
+            row["confidence"],
+            from_minor_units(row["subs_merchant_sum"]),
             row["num_subs_tx"],
-            str(row["active"])
-        ], value_input_option='USER_ENTERED')
-
-        new_row_index = len(ws_output.get_all_values())
-        format_row_in_worksheet(ws_output, new_row_index, "normal")
+            str(row["active"]),
+            row["category"]
+            ]
+        for row in dataset
+        ]
 
 
-def append_dataset2_rows(ws_output, dataset):
+def get_dataset2_rows(dataset):
     """
-    Append the rows of dataset2 to the worksheet
+    Convert the rows of dataset2 into worksheet rows
     """
-    for row in dataset:
-        ws_output.append_row([
+    return [
+        [
             row[TX_MERCHANT_KEY],
             convert_datetime_object_to_str(row["last_tx_date"]),
             convert_datetime_object_to_str(row["first_tx_date"]),
-            row["last_tx_amount"],
-            row["merchant_sum"],
-            row["num_tx"]
-        ], value_input_option='USER_ENTERED')
-
-        new_row_index = len(ws_output.get_all_values())
-        format_row_in_worksheet(ws_output, new_row_index, "normal")
+            from_minor_units(row["last_tx_amount"]),
+            from_minor_units(row["merchant_sum"]),
+            row["num_tx"],
+            row["category"]
+            ]
+        for row in dataset
+        ]
 
 
-def append_sorted_rows(ws_output, dataset):
+def get_sorted_rows(dataset):
     """
-    Append the rows of sorted_clean data to the worksheet
+    Convert the rows of sorted_clean data into worksheet rows
     """
-    for row in dataset:
-        ws_output.append_row([
+    return [
+        [
             convert_datetime_object_to_str(row[TX_DATE_KEY]),
             row[TX_MERCHANT_KEY],
-            row[TX_AMOUNT_KEY],
-        ], value_input_option='USER_ENTERED')
+            from_minor_units(row[TX_AMOUNT_KEY]),
+            ]
+        for row in dataset
+        ]
+
+
+class SheetsRateLimiter:
+    """
+    Spread the Google Sheets write requests of all threads evenly so
+    they stay within the per minute write quota
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_request = 0
+
+    def wait(self):
+        """
+        Block until the calling thread may send its next request
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+SHEETS_RATE_LIMITER = SheetsRateLimiter(SHEETS_WRITES_PER_MINUTE)
+
+
+def build_results_block(heading, keys_list, data_rows, start_date, end_date):
+    """
+    Build one results block: the heading, the analysis time frame and
+    the headings row above the data rows
+    Returns: header rows, data rows
+    """
+    header_rows = [
+        [heading],
+        ["Start-Date", convert_datetime_object_to_str(start_date)],
+        ["End-Date", convert_datetime_object_to_str(end_date)],
+        [""],
+        keys_list
+        ]
+    return header_rows, data_rows
+
+
+def plan_results_shards(blocks, max_rows):
+    """
+    Plan the worksheets needed for the results blocks. Blocks are put
+    one after the other into a worksheet as long as they fit into
+    max_rows. A block that is too big for one worksheet is split and
+    its header rows are repeated in every worksheet it continues in
+    Returns: list of (rows, bold rows) per worksheet, the bold rows
+    are zero-based row indices
+    """
+    shards = []
+    rows = []
+    bold_rows = []
+
+    for header_rows, data_rows in blocks:
+        next_row = 0
+        while True:
+            remaining = len(data_rows) - next_row
+            # a separator row between two blocks in the same worksheet
+            separator = [[""]] if rows else []
+            free_rows = max_rows - len(rows) - len(separator) - \
+                len(header_rows)
+
+            # let's start a new worksheet if not even one data row fits or
+            # if the rest of the block fits completely into a new one
+            if rows and (free_rows < min(remaining, 1) or (
+                    free_rows < remaining and
+                    remaining + len(header_rows) <= max_rows)):
+                shards.append((rows, bold_rows))
+                rows = []
+                bold_rows = []
+                continue
+
+            rows.extend(separator)
+            bold_rows.extend([len(rows), len(rows) + len(header_rows) - 1])
+            rows.extend(header_rows)
+
+            num_rows = max(max_rows - len(rows), 1)
+            rows.extend(data_rows[next_row:next_row + num_rows])
+            next_row += num_rows
+            if next_row >= len(data_rows):
+                break
+
+            # the worksheet is full, the block continues in the next one
+            shards.append((rows, bold_rows))
+            rows = []
+            bold_rows = []
+
+    if rows:
+        shards.append((rows, bold_rows))
+
+    return shards
+
+
+def write_results_shard(ws_output, rows, bold_rows, first_chunk=0,
+                        commit_chunk=None):
+    """
+    Write the rows of one worksheet in numbered chunks of
+    RESULTS_WRITE_CHUNK_ROWS, starting with first_chunk, and format the
+    bold rows in a single request. commit_chunk(chunk) is called after
+    each chunk has been written
+    """
+    num_chunks = math.ceil(len(rows) / RESULTS_WRITE_CHUNK_ROWS)
+    for chunk in range(first_chunk, num_chunks):
+        start = chunk * RESULTS_WRITE_CHUNK_ROWS
+        SHEETS_RATE_LIMITER.wait()
+        ws_output.update(rows[start:start + RESULTS_WRITE_CHUNK_ROWS],
+                         f"A{start + 1}", value_input_option='USER_ENTERED')
+        if commit_chunk:
+            commit_chunk(chunk)
+
+    if bold_rows:
+        last_col = column_number_to_letter(ws_output.col_count)
+        bold = CellFormat(textFormat=TextFormat(bold=True))
+        SHEETS_RATE_LIMITER.wait()
+        format_cell_ranges(ws_output, [
+            (f"A{row + 1}:{last_col}{row + 1}", bold) for row in bold_rows
+            ])
+
+
+def get_shard_worksheet_names(worksheet_name, num_shards):
+    """
+    Return: worksheet_name for a single worksheet, otherwise
+    'worksheet_name 1..n'
+    """
+    if num_shards == 1:
+        return [worksheet_name]
+
+    return [f"{worksheet_name} {i}" for i in range(1, num_shards + 1)]
+
+
+def get_upload_hash(worksheet_names, shards):
+    """
+    Return: sha256 hex digest of everything that gets uploaded
+    """
+    return hashlib.sha256(
+        repr((worksheet_names, shards)).encode("utf-8")).hexdigest()
+
+
+def get_upload_checkpoint_file(spreadsheet, upload_hash):
+    """
+    Build the file name of the upload checkpoint. It is named after the
+    spreadsheet and the upload hash, so only an upload of exactly the
+    same rows resumes from it
+    """
+    return os.path.join(UPLOAD_CHECKPOINT_DIR,
+                        f"{spreadsheet.id}_{upload_hash}.json")
+
+
+def get_upload_rows_file(spreadsheet, upload_hash):
+    """
+    Build the file name of the planned rows of an upload, which are
+    saved once next to its checkpoint
+    """
+    return os.path.join(UPLOAD_CHECKPOINT_DIR,
+                        f"{spreadsheet.id}_{upload_hash}.rows")
+
+
+def save_upload_checkpoint(checkpoint_file, checkpoint):
+    """
+    Write the upload checkpoint, replacing the previous one in one step
+    """
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    with open(checkpoint_file + ".tmp", "w") as json_file:
+        json.dump(checkpoint, json_file)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+
+def remove_upload_checkpoint(spreadsheet, upload_hash):
+    """
+    Remove the checkpoint and the planned rows of an upload
+    """
+    for file_name in (get_upload_checkpoint_file(spreadsheet, upload_hash),
+                      get_upload_rows_file(spreadsheet, upload_hash)):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+def write_results_shards(spreadsheet, worksheet_names, shards,
+                         checkpoint=None):
+    """
+    Create the worksheets and write the shards in parallel. Before the
+    first chunk the planned rows are saved once and a small local
+    checkpoint records the target spreadsheet and worksheets and the
+    hash of the upload, after every chunk the checkpoint records the
+    last committed chunk of each worksheet.
+    An interrupted upload continues after the last committed chunks:
+    either from the checkpoint passed in (see resume_upload) or from
+    the checkpoint of a previous upload of the same rows
+    If Sheets rejects a request (400), the worksheets created here and
+    the checkpoint are removed again before the error is raised
+    """
+    if checkpoint is None:
+        upload_hash = get_upload_hash(worksheet_names, shards)
+        checkpoint_file = get_upload_checkpoint_file(spreadsheet,
+                                                     upload_hash)
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as json_file:
+                checkpoint = json.load(json_file)
+    else:
+        upload_hash = checkpoint["upload_hash"]
+        checkpoint_file = get_upload_checkpoint_file(spreadsheet,
+                                                     upload_hash)
+
+    resume = checkpoint is not None
+    if resume:
+        print("Resuming the interrupted upload...")
+    else:
+        # the rows don't change during the upload, so they are written
+        # only once and the checkpoint stays small
+        save_upload_checkpoint(get_upload_rows_file(spreadsheet,
+                                                    upload_hash), shards)
+        checkpoint = {
+            "spreadsheet_id": spreadsheet.id,
+            "upload_hash": upload_hash,
+            "worksheets": worksheet_names,
+            "last_chunks": {name: -1 for name in worksheet_names}
+            }
+        save_upload_checkpoint(checkpoint_file, checkpoint)
+        print(f"Creating {len(shards)} new worksheet(s)...")
+
+    wsheets = []
+    new_wsheets = []
+    checkpoint_lock = threading.Lock()
+
+    def write_shard(ws_output, rows, bold_rows):
+        def commit_chunk(chunk):
+            with checkpoint_lock:
+                checkpoint["last_chunks"][ws_output.title] = chunk
+                save_upload_checkpoint(checkpoint_file, checkpoint)
+
+        write_results_shard(ws_output, rows, bold_rows,
+                            checkpoint["last_chunks"][ws_output.title] + 1,
+                            commit_chunk)
+
+    try:
+        for name, (rows, bold_rows) in zip(worksheet_names, shards):
+            try:
+                if not resume:
+                    raise gspread.exceptions.WorksheetNotFound(name)
+                wsheets.append(spreadsheet.worksheet(name))
+
+            except gspread.exceptions.WorksheetNotFound:
+                # creating the worksheet with its final size
+                new_wsheets.append(spreadsheet.add_worksheet(
+                    title=name, rows=max(len(rows), 1), cols=RESULTS_COLS))
+                wsheets.append(new_wsheets[-1])
+
+        print("Uploading the data...")
+        with ThreadPoolExecutor(
+                max_workers=SHEETS_MAX_PARALLEL_WRITES) as pool:
+            list(pool.map(write_shard, wsheets, *zip(*shards)))
+
+    except APIError as e:
+        if e.response.status_code == 400:
+            # the upload is given up, so let's not leave half-written
+            # worksheets behind
+            for ws_output in new_wsheets:
+                spreadsheet.del_worksheet(ws_output)
+            remove_upload_checkpoint(spreadsheet, upload_hash)
+        raise
+
+    # all done, nothing to resume
+    remove_upload_checkpoint(spreadsheet, upload_hash)
+    return True
+
+
+def load_upload_checkpoints(spreadsheet):
+    """
+    Load the checkpoints of the interrupted uploads to spreadsheet
+    Returns: list of (checkpoint, planned rows) (see
+    write_results_shards)
+    """
+    checkpoints = []
+    try:
+        file_names = sorted(os.listdir(UPLOAD_CHECKPOINT_DIR))
+    except FileNotFoundError:
+        return checkpoints
+
+    for file_name in file_names:
+        if not (file_name.startswith(f"{spreadsheet.id}_") and
+                file_name.endswith(".json")):
+            continue
+
+        try:
+            with open(os.path.join(UPLOAD_CHECKPOINT_DIR,
+                                   file_name)) as json_file:
+                checkpoint = json.load(json_file)
+            with open(get_upload_rows_file(
+                    spreadsheet, checkpoint["upload_hash"])) as json_file:
+                shards = [(rows, bold_rows)
+                          for rows, bold_rows in json.load(json_file)]
+
+        except FileNotFoundError:
+            # checkpoints of older versions don't have the planned rows
+            continue
+
+        except (OSError, ValueError, KeyError) as e:
+            print(f"\nRET couldn't read the upload checkpoint: {e}")
+            continue
+
+        checkpoints.append((checkpoint, shards))
+
+    return checkpoints
+
+
+def resume_upload(spreadsheet):
+    """
+    Offer to finish the interrupted uploads to spreadsheet from the rows
+    saved next to their checkpoints, without importing and analyzing the
+    data again. A declined upload is discarded
+    Returns: True if at least one upload was finished
+    """
+    num_resumed = 0
+
+    for checkpoint, shards in load_upload_checkpoints(spreadsheet):
+        worksheet_names = checkpoint["worksheets"]
+        resume = input(f"\nRET found an interrupted upload to worksheet(s) \
+                       \n{', '.join(worksheet_names)}. Do you want RET to \
+                       \nfinish it now? (y/n):\n")
+
+        if resume.strip().lower() != "y":
+            remove_upload_checkpoint(spreadsheet, checkpoint["upload_hash"])
+            continue
+
+        try:
+            write_results_shards(spreadsheet, worksheet_names, shards,
+                                 checkpoint)
+            print(f"\nThe upload to worksheet(s) \
+                  \n{', '.join(worksheet_names)} has been finished.")
+            num_resumed += 1
+
+        except (APIError, GSpreadException) as e:
+            print(f"\nAn error occurred trying to finish the upload: {e}")
+
+    return num_resumed > 0
+
+
+def get_results_row_keys(rows):
+    """
+    Build a key for every row of a results worksheet so an existing
+    worksheet can be compared with new results. Data rows are keyed by
+    their block heading, merchant and start date, all other rows by
+    their block heading and position. Start dates read back as Sheets
+    serial numbers (UNFORMATTED_VALUE) are keyed by the same date string
+    RET writes
+    Returns: list of keys, one per row
+    """
+    keys = []
+    heading = None
+    header_pos = 0
+    key_col = 1
+    key_is_date = False
+
+    for row in rows:
+        cells = [str(cell) for cell in row]
+
+        if heading is None:
+            # first row of a new block
+            heading = cells[0] if cells else ""
+            header_pos = 0
+
+        if header_pos < RESULTS_HEADER_ROWS:
+            if header_pos == RESULTS_HEADER_ROWS - 1:
+                # the headings row tells us where the start date is
+                key_col = next((i for i, cell in enumerate(cells)
+                                if cell in RESULTS_KEY_COLUMNS), None)
+                key_is_date = key_col is not None
+                if not key_is_date:
+                    key_col = 1
+            keys.append((heading, "#", header_pos))
+            header_pos += 1
+
+        elif not any(cells):
+            # separator row, the next row starts a new block
+            keys.append((heading, "#", "end"))
+            heading = None
+
+        else:
+            key_value = row[key_col] if key_col < len(row) else ""
+            if key_is_date and isinstance(key_value, (int, float)) and \
+                    not isinstance(key_value, bool):
+                key_value = convert_datetime_object_to_str(
+                    SHEETS_EPOCH + timedelta(days=key_value))
+            keys.append((heading, cells[0], str(key_value)))
+
+    return keys
+
+
+def cell_value_matches(old_value, new_value):
+    """
+    Compare a cell value read from the worksheet (unformatted) with
+    the value RET would write. Numbers are compared as numbers and our
+    date strings also match the serial number Sheets stores for dates
+    """
+    if str(old_value) == str(new_value):
+        return True
+
+    if isinstance(old_value, bool) or isinstance(new_value, bool):
+        return str(old_value).lower() == str(new_value).lower()
+
+    if isinstance(old_value, (int, float)):
+        if isinstance(new_value, (int, float)):
+            return old_value == new_value
+
+        try:
+            new_date = datetime.strptime(str(new_value), '%d.%m.%Y')
+            return old_value == (new_date - SHEETS_EPOCH).days
+
+        except ValueError:
+            return False
+
+    return False
+
+
+def get_changed_cell_ranges(row_index, old_row, new_row):
+    """
+    Compare one row of the worksheet with its new values
+    Returns: list of {"range", "values"} for every run of changed cells
+    """
+    width = max(len(old_row), len(new_row))
+    old_row = list(old_row) + [""] * (width - len(old_row))
+    new_row = list(new_row) + [""] * (width - len(new_row))
+
+    changed_ranges = []
+    col = 0
+    while col < width:
+        if cell_value_matches(old_row[col], new_row[col]):
+            col += 1
+            continue
+
+        start_col = col
+        while col < width and \
+                not cell_value_matches(old_row[col], new_row[col]):
+            col += 1
+
+        changed_ranges.append({
+            "range": f"{column_number_to_letter(start_col + 1)}"
+                     f"{row_index + 1}:"
+                     f"{column_number_to_letter(col)}{row_index + 1}",
+            "values": [new_row[start_col:col]]
+            })
+
+    return changed_ranges
 
-        new_row_index = len(ws_output.get_all_values())
-        format_row_in_worksheet(ws_output, new_row_index, "normal")
+
+def refresh_results_worksheet(ws_output, rows, bold_rows):
+    """
+    Update an existing results worksheet in place: read it once,
+    compare it with the new rows, insert and delete rows where results
+    were added or removed and write only the changed cells. Worksheets
+    with fewer than RESULTS_COLS columns are widened first
+    Returns: True if successful, False in case of any error
+    """
+    print(f"\nComparing the new results with worksheet \
+          \n'{ws_output.title}'...")
+
+    old_rows = ws_output.get_all_values(
+        value_render_option="UNFORMATTED_VALUE")
+
+    matcher = difflib.SequenceMatcher(None, get_results_row_keys(old_rows),
+                                      get_results_row_keys(rows),
+                                      autojunk=False)
+
+    structure_requests = []
+    value_ranges = []
+    inserted_rows = 0
+    deleted_rows = 0
+
+    def dimension_range(start, end):
+        return {"sheetId": ws_output.id, "dimension": "ROWS",
+                "startIndex": start, "endIndex": end}
+
+    # all row indices are positions in the new rows: going from top to
+    # bottom, everything above has already been inserted or deleted
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        num_paired = min(i2 - i1, j2 - j1)
+        for k in range(num_paired):
+            value_ranges.extend(get_changed_cell_ranges(
+                j1 + k, old_rows[i1 + k], rows[j1 + k]))
+
+        if i2 - i1 > num_paired:
+            structure_requests.append({"deleteDimension": {
+                "range": dimension_range(j1 + num_paired,
+                                         j1 + i2 - i1)}})
+            deleted_rows += i2 - i1 - num_paired
+
+        if j2 - j1 > num_paired:
+            structure_requests.append({"insertDimension": {
+                "range": dimension_range(j1 + num_paired, j2),
+                "inheritFromBefore": False}})
+            inserted_rows += j2 - j1 - num_paired
+            for j in range(j1 + num_paired, j2):
+                value_ranges.extend(get_changed_cell_ranges(j, [], rows[j]))
+
+    if not structure_requests and not value_ranges:
+        print("The worksheet is already up to date.")
+        return True
+
+    # older or hand-made worksheets may be narrower than the results,
+    # the cells beyond the grid can't be written before it's widened
+    num_cols = max([RESULTS_COLS] + [len(row) for row in rows])
+    if ws_output.col_count < num_cols:
+        structure_requests.insert(0, {"appendDimension": {
+            "sheetId": ws_output.id, "dimension": "COLUMNS",
+            "length": num_cols - ws_output.col_count}})
+
+    if structure_requests:
+        # rows have moved or columns were added, so let's re-apply the
+        # bold rows as well
+        sheet_range = {"sheetId": ws_output.id, "startColumnIndex": 0,
+                       "endColumnIndex": max(ws_output.col_count,
+                                             num_cols)}
+        structure_requests.append({"repeatCell": {
+            "range": sheet_range,
+            "cell": {"userEnteredFormat": {"textFormat": {"bold": False}}},
+            "fields": "userEnteredFormat.textFormat.bold"}})
+        structure_requests.extend({"repeatCell": {
+            "range": dict(sheet_range, startRowIndex=row,
+                          endRowIndex=row + 1),
+            "cell": {"userEnteredFormat": {"textFormat": {"bold": True}}},
+            "fields": "userEnteredFormat.textFormat.bold"}}
+            for row in bold_rows)
+        ws_output.spreadsheet.batch_update({"requests": structure_requests})
+
+    if value_ranges:
+        ws_output.batch_update(value_ranges,
+                               value_input_option='USER_ENTERED')
+
+    num_cells = sum(len(value_range["values"][0])
+                    for value_range in value_ranges)
+    print(f"\nRET updated {num_cells} cells, inserted {inserted_rows} \
+          \nand deleted {deleted_rows} rows in '{ws_output.title}'.")
+    return True
+
+
+def get_new_worksheet_name(spreadsheet, worksheet_name):
+    """
+    Tell the user that worksheet_name already exists and ask for
+    a different name
+    """
+    print(f"\nA worksheet with the name '{worksheet_name}' \
+          \nalready exists in the spreadsheet: '{spreadsheet.title}'.")
+    new_worksheet_name = input("Please enter a different name \
+                               \nfor the worksheet:\n")
+    return new_worksheet_name
 
 
 def upload_results_to_worksheet(spreadsheet, worksheet_name,
                                 heading_dataset1, dataset1,
                                 heading_dataset2, dataset2,
-                                start_date, end_date):
+                                start_date, end_date, extra_blocks=None,
+                                result_hash=None):
     """
     create a new worksheet with worksheet_name in spreadsheet and
     upload the data to the selected worksheet
     function can handle max two datasets. Each one is optional
+    extra_blocks: optional list of (heading, keys_list, rows) for
+    further results blocks
+    result_hash: optional hash of the result. It is written to
+    RESULT_HASH_CELL and nothing is uploaded if the worksheet already
+    holds this result
+    The size of the results is planned up front: the worksheets are
+    created with their final size and if the results are longer than
+    RESULTS_MAX_ROWS_PER_SHEET they are split across the worksheets
+    'worksheet_name 1..n' which are written in parallel
     """
     print("\nStarting the results upload to Google Sheets...")
 
     try:
-        print("Creating a new worksheet...")
-        # creating the worksheet
-        ws_output = spreadsheet.add_worksheet(
-            title=worksheet_name, rows=1, cols=10)
-
-        print("Uploading the data...")
-        print("NOTE: this may take a while\
-              \nplease be patient!...")
-
-        # filling in the data
+        blocks = []
         if dataset1:
-            # Insert heading for dataset1
-            append_and_format_row(ws_output, [heading_dataset1], "bold")
-            append_and_format_row(ws_output, [
-                "Start-Date", convert_datetime_object_to_str(start_date)],
-                "normal")
-            append_and_format_row(ws_output, [
-                "End-Date", convert_datetime_object_to_str(end_date)],
-                "normal")
-            append_and_format_row(ws_output, [], "normal")
-
-            # Append dataset headings
-            append_dataset1_headings(ws_output)
-
-            # Append dataset rows
-            append_dataset1_rows(ws_output, dataset1)
+            blocks.append(build_results_block(
+                heading_dataset1, get_dataset1_headings(),
+                get_dataset1_rows(dataset1), start_date, end_date))
 
         if dataset2:
-            # Insert heading for dataset2
-            append_and_format_row(ws_output, [], "normal")
-            append_and_format_row(ws_output, [heading_dataset2], "bold")
-            append_and_format_row(ws_output, [
-                "Start-Date", convert_datetime_object_to_str(start_date)],
-                "normal")
-            append_and_format_row(ws_output, [
-                "End-Date", convert_datetime_object_to_str(end_date)],
-                "normal")
-            append_and_format_row(ws_output, [], "normal")
-
-            # Append dataset headings
-            append_dataset2_headings(ws_output)
-
-            # Append dataset rows
-            append_dataset2_rows(ws_output, dataset2)
+            blocks.append(build_results_block(
+                heading_dataset2, get_dataset2_headings(),
+                get_dataset2_rows(dataset2), start_date, end_date))
+
+        for heading, keys_list, rows in extra_blocks or []:
+            if rows:
+                blocks.append(build_results_block(
+                    heading, keys_list, rows, start_date, end_date))
+
+        shards = plan_results_shards(blocks, RESULTS_MAX_ROWS_PER_SHEET)
+        if not shards:
+            print("\nThere are no results, nothing to upload.")
+            return True
+
+        if result_hash:
+            first_row = shards[0][0][0]
+            shards[0][0][0] = first_row + [""] * (
+                RESULTS_COLS - 1 - len(first_row)) + [result_hash]
+        worksheet_names = get_shard_worksheet_names(worksheet_name,
+                                                    len(shards))
+
+        # if an upload of exactly these rows was interrupted before, it
+        # continues where it stopped and there is nothing to check
+        resume = os.path.exists(get_upload_checkpoint_file(
+            spreadsheet, get_upload_hash(worksheet_names, shards)))
+
+        if not resume and result_hash and worksheet_holds_result(
+                spreadsheet, worksheet_names[0], result_hash):
+            print(f"\nThe worksheet '{worksheet_names[0]}' already holds \
+                  \nthese results. Nothing to upload.")
+            return True
+
+        # let's check the names and the size of the spreadsheet before
+        # creating anything
+        existing_wsheets = spreadsheet.worksheets()
+        existing_names = {ws.title for ws in existing_wsheets}
+        for name in worksheet_names:
+            if not resume and name in existing_names:
+                # results that fit into one worksheet can be refreshed in
+                # place instead of creating yet another worksheet
+                if len(shards) == 1:
+                    update = input(f"\nThe worksheet '{name}' already \
+                                   \nexists. Do you want RET to update it \
+                                   \nwith the new results? (y/n):\n")
+                    if update.strip().lower() == "y":
+                        rows, bold_rows = shards[0]
+                        return refresh_results_worksheet(
+                            spreadsheet.worksheet(name), rows, bold_rows)
+
+                new_worksheet_name = get_new_worksheet_name(spreadsheet, name)
+                return upload_results_to_worksheet(
+                    spreadsheet, new_worksheet_name, heading_dataset1,
+                    dataset1, heading_dataset2, dataset2, start_date,
+                    end_date, extra_blocks, result_hash)
+
+        used_cells = sum(ws.row_count * ws.col_count
+                         for ws in existing_wsheets
+                         if ws.title not in worksheet_names)
+        planned_cells = sum(len(rows) for rows, bold_rows in shards) * \
+            RESULTS_COLS
+        if used_cells + planned_cells > SHEETS_MAX_CELLS:
+            print(f"\nThe results need {planned_cells} cells but the \
+                  \nspreadsheet: '{spreadsheet.title}' only has \
+                  \n{SHEETS_MAX_CELLS - used_cells} cells left.")
+            return False
+
+        write_results_shards(spreadsheet, worksheet_names, shards)
 
         print(f"\nThe data has been successfully uploaded to Spreadsheet: \
-                \n'{spreadsheet.title}' | worksheet: '{worksheet_name}'")
+                \n'{spreadsheet.title}' | worksheet: \
+                \n{', '.join(worksheet_names)}")
         print(f"\nStart date: {convert_datetime_object_to_str(start_date)}\
                 \nEnd date: {convert_datetime_object_to_str(end_date)}\n")
         return True
 
     except APIError as e:
         if e.response.status_code == 400:
-            print(f"\nA worksheet with the name '{worksheet_name}' \
-                  \nalready exists in the spreadsheet: '{spreadsheet.title}'.")
-            new_worksheet_name = input("Please enter a different name \
-                                       \nfor the worksheet:\n")
+            new_worksheet_name = get_new_worksheet_name(spreadsheet,
+                                                        worksheet_name)
             # let's call this function recursively to get things done with
             # a new name for the worksheet
             if upload_results_to_worksheet(spreadsheet, new_worksheet_name,
                                            heading_dataset1, dataset1,
                                            heading_dataset2, dataset2,
-                                           start_date, end_date):
+                                           start_date, end_date,
+                                           extra_blocks, result_hash):
                 return True
             else:
                 return False
@@ -692,39 +1462,38 @@ def upload_sorted_to_worksheet(spreadsheet, worksheet_name,
     """
     create a new worksheet with worksheet_name in spreadsheet and
     upload the data to the selected worksheet
+    The upload is checkpointed like the results upload, so an
+    interrupted upload continues where it stopped
     """
     print("\nStarting the data upload to Google Sheets...")
 
     try:
-        print("Creating new worksheet...")
-        # creating the worksheet
-        ws_output = spreadsheet.add_worksheet(
-            title=worksheet_name, rows=1, cols=10)
-
-        print("Uploading the data. NOTE: this may \
-              take a while - please be patient!...")
-
-        # filling in the data
-        if dataset1:
-            # Insert heading for dataset1
-            append_and_format_row(ws_output, [heading_dataset1],
-                                  "bold")
-            append_and_format_row(ws_output, ["Start-Date",
-                                              convert_datetime_object_to_str
-                                              (start_date)], "normal")
-            append_and_format_row(ws_output, ["End-Date",
-                                              convert_datetime_object_to_str
-                                              (end_date)], "normal")
-            append_and_format_row(ws_output, [], "normal")
-
-            # Append dataset headings
-            append_sorted_headings(ws_output)
-
-            # Append dataset rows
-            append_sorted_rows(ws_output, dataset1)
+        keys_list = [
+            TX_DATE_KEY,
+            TX_MERCHANT_KEY,
+            TX_AMOUNT_KEY,
+            ]
+        shards = plan_results_shards([build_results_block(
+            heading_dataset1, keys_list, get_sorted_rows(dataset1),
+            start_date, end_date)], RESULTS_MAX_ROWS_PER_SHEET)
+        worksheet_names = get_shard_worksheet_names(worksheet_name,
+                                                    len(shards))
+
+        if not os.path.exists(get_upload_checkpoint_file(
+                spreadsheet, get_upload_hash(worksheet_names, shards))):
+            existing_names = {ws.title for ws in spreadsheet.worksheets()}
+            for name in worksheet_names:
+                if name in existing_names:
+                    new_worksheet_name = get_new_worksheet_name(spreadsheet,
+                                                                name)
+                    return upload_sorted_to_worksheet(
+                        spreadsheet, new_worksheet_name, heading_dataset1,
+                        dataset1, start_date, end_date)
+
+        write_results_shards(spreadsheet, worksheet_names, shards)
 
         print(f"\nThe data has been successfully uploaded to Spreadsheet: \n\
-              {spreadsheet.title} | worksheet: {worksheet_name}.")
+              {spreadsheet.title} | worksheet: {', '.join(worksheet_names)}.")
         print(f"\nStart date of the dataset: \
               {convert_datetime_object_to_str(start_date)} \
                 \n| End date: {convert_datetime_object_to_str(end_date)}\n")
@@ -732,15 +1501,13 @@ def upload_sorted_to_worksheet(spreadsheet, worksheet_name,
 
     except APIError as e:
         if e.response.status_code == 400:
-            print(f"\nA worksheet with the name '{worksheet_name}' \
-                  \nalready exists in the spreadsheet: '{spreadsheet.title}'.")
-            new_worksheet_name = input("Please enter a different name for \
-                                       \nthe worksheet:\n")
+            new_worksheet_name = get_new_worksheet_name(spreadsheet,
+                                                        worksheet_name)
             # let's call this function recursively to get things done
             # with a new name for the worksheet
-            if upload_results_to_worksheet(spreadsheet, new_worksheet_name,
-                                           heading_dataset1, dataset1,
-                                           start_date, end_date):
+            if upload_sorted_to_worksheet(spreadsheet, new_worksheet_name,
+                                          heading_dataset1, dataset1,
+                                          start_date, end_date):
                 return True
             else:
                 return False
@@ -762,6 +1529,117 @@ def upload_sorted_to_worksheet(spreadsheet, worksheet_name,
         return False
 
 
+def build_drilldown_rows(tx_data):
+    """
+    Build the drill-down of every subscription and recurring merchant:
+    a header row per merchant, its individual transactions and a
+    sub-total row
+    Returns: rows (list of lists), indices of the rows to be formatted
+    bold and (start, end) row indices of the transaction groups
+    """
+    rows = [
+        ["INDIVIDUAL PURCHASES"],
+        ["Start-Date",
+         convert_datetime_object_to_str(tx_data.ANALYSIS_START_DATE)],
+        ["End-Date",
+         convert_datetime_object_to_str(tx_data.ANALYSIS_END_DATE)],
+        ["-"],
+        [TX_DATE_KEY, TX_MERCHANT_KEY, TX_AMOUNT_KEY]
+        ]
+    bold_rows = [0, 4]
+    groups = []
+
+    # every subscription stream and recurring merchant lists exactly
+    # the transactions the analysis counted for it
+    drilldown_entries = [
+        (row[TX_MERCHANT_KEY], "subscription " + row["subs_frequency"],
+         row["transactions"])
+        for row in tx_data.subscriptions_data
+        ] + [
+        (row[TX_MERCHANT_KEY], "recurring merchant", row["transactions"])
+        for row in tx_data.recurring_merchants_data
+        ]
+
+    for merchant, entry_type, entry_tx in drilldown_entries:
+        bold_rows.append(len(rows))
+        rows.append([merchant, entry_type.strip()])
+
+        groups.append((len(rows), len(rows) + len(entry_tx)))
+        rows.extend([
+            convert_datetime_object_to_str(tx_date),
+            merchant,
+            from_minor_units(amount)
+            ] for tx_date, amount in entry_tx)
+
+        bold_rows.append(len(rows))
+        rows.append(["Sub-total", len(entry_tx), from_minor_units(
+            sum(amount for tx_date, amount in entry_tx))])
+
+    return rows, bold_rows, groups
+
+
+def upload_drilldown_to_worksheet(spreadsheet, worksheet_name, tx_data):
+    """
+    create a new worksheet with worksheet_name in spreadsheet and
+    upload the drill-down of all subscriptions and recurring merchants.
+    The rows are built in memory and written in a single values write,
+    the bold rows and collapsible row groups in one batch update
+    """
+    print("\nStarting the drill-down upload to Google Sheets...")
+
+    try:
+        rows, bold_rows, groups = build_drilldown_rows(tx_data)
+
+        print("Creating a new worksheet...")
+        ws_output = spreadsheet.add_worksheet(
+            title=worksheet_name, rows=len(rows), cols=3)
+
+        print("Uploading the data...")
+        ws_output.update(rows, "A1", value_input_option='USER_ENTERED')
+
+        requests = [
+            {"repeatCell": {
+                "range": {"sheetId": ws_output.id,
+                          "startRowIndex": row, "endRowIndex": row + 1,
+                          "startColumnIndex": 0, "endColumnIndex": 3},
+                "cell": {"userEnteredFormat": {
+                    "textFormat": {"bold": True}}},
+                "fields": "userEnteredFormat.textFormat.bold"}}
+            for row in bold_rows
+            ] + [
+            {"addDimensionGroup": {
+                "range": {"sheetId": ws_output.id, "dimension": "ROWS",
+                          "startIndex": start, "endIndex": end}}}
+            for start, end in groups if end > start
+            ]
+        spreadsheet.batch_update({"requests": requests})
+
+        print(f"\nThe drill-down has been successfully uploaded to \
+                \n'{spreadsheet.title}' | worksheet: '{worksheet_name}'")
+        return True
+
+    except APIError as e:
+        if e.response.status_code == 400:
+            print(f"\nA worksheet with the name '{worksheet_name}' \
+                  \nalready exists in the spreadsheet: '{spreadsheet.title}'.")
+            new_worksheet_name = input("Please enter a different name \
+                                       \nfor the worksheet:\n")
+            # let's call this function recursively to get things done with
+            # a new name for the worksheet
+            return upload_drilldown_to_worksheet(spreadsheet,
+                                                 new_worksheet_name, tx_data)
+
+        else:
+            print(f"\nAn API error occurred: {e}")
+            print(f"Status Code: {e.response.status_code}")
+            print(f"Error Message: {e.response.text}")
+            return False
+
+    except GSpreadException as e:
+        print(f"\nAn error occurred trying to access the spreadsheet: {e}")
+        return False
+
+
 def print_data(number_of_rows, data, clean):
     """
     Print the provided number_of_rows of the data requested
@@ -806,6 +1684,9 @@ def print_data(number_of_rows, data, clean):
 def check_import_raw_data(sheet, tx_data):
     """
     Check the raw data for any errors and import
+    If the result of exactly this data and the current settings is in
+    the result cache it is loaded into tx_data instead and the data
+    isn't cleaned (tx_data.result_hash is set)
     """
     # setting the message to a default value
     message = "An error occurred while cleaning the transaction data.\
@@ -814,6 +1695,33 @@ def check_import_raw_data(sheet, tx_data):
     try:
         selected_raw_tx_data = []
         is_data_clean = False
+        account = tx_account_key(sheet)
+
+        # let's check if we have already cleaned this worksheet in a
+        # previous run so we can skip importing and cleaning it again
+        tx_binary_file = tx_binary_file_name(sheet)
+        if os.path.exists(tx_binary_file):
+            reuse_data = input("\nRET found the cleaned transaction data \
+                    \nfrom a previous run of this worksheet.\
+                    \nDo you want to re-use it? (y/n):\n")
+
+            if reuse_data.strip().lower() == "y":
+                tx_file = open_tx_binary(tx_binary_file)
+                if tx_file:
+                    try:
+                        # the file is hashed as it is, so if its result
+                        # is cached no row has to be converted back
+                        if not load_result_of_source(
+                                tx_data, account, tx_file.get_source_hash()):
+                            tx_data.clean_tx_data = \
+                                tx_file.to_clean_tx_data()
+                    finally:
+                        tx_file.close()
+
+                    print("The cleaned transaction data has been \
+                          \nsuccessfully reloaded.\n")
+                    tx_data.selected_raw_tx_data = selected_raw_tx_data
+                    return True
 
         while not is_data_clean:
             # import raw transaction data from the worksheet
@@ -827,6 +1735,13 @@ def check_import_raw_data(sheet, tx_data):
             if raw_data_ok == "n":
                 is_data_clean = False
 
+            elif load_result_of_source(
+                    tx_data, account, get_source_hash(selected_raw_tx_data)):
+                # we have analyzed exactly this data with the same
+                # settings before, no need to clean it again
+                tx_data.selected_raw_tx_data = selected_raw_tx_data
+                return True
+
             else:
                 # let's check the date format of the input data
                 tx_data.check_date_format(selected_raw_tx_data)
@@ -835,6 +1750,10 @@ def check_import_raw_data(sheet, tx_data):
                 print("Cleaning up the imported transaction data...")
                 clean_data = tx_data.clean_up_tx_data(selected_raw_tx_data)
                 if not clean_data:
+                    # the rejected rows are what the user needs to fix
+                    # the data before trying again
+                    offer_quarantine(sheet.spreadsheet,
+                                     tx_data.validation_report)
                     cprint(message, 'red')
                     try_again = input("(y/n):\n")
                     try_again = try_again.strip().lower()
@@ -847,6 +1766,12 @@ def check_import_raw_data(sheet, tx_data):
                     is_data_clean = True
 
         print("The raw transaction data has been successfully imported.\n")
+
+        # let's give the user the rows RET had to reject to review
+        offer_quarantine(sheet.spreadsheet, tx_data.validation_report)
+
+        # let's save the cleaned data so the next run can reload it
+        write_tx_binary(tx_binary_file, clean_data)
         tx_data.clean_tx_data = clean_data
         tx_data.selected_raw_tx_data = selected_raw_tx_data
         return True
@@ -859,43 +1784,1911 @@ def check_import_raw_data(sheet, tx_data):
 
 
 #################################################################
-# CLASS TxData                                                  #
+# SCHEMA INFERENCE                                              #
 #################################################################
-class TxData:
+def get_cell_type(tx_data, value):
     """
-    Class to handle all aspects of the transaction data incl:
-    clean_up and analysis
-    Input: list of dictionaries: selected_raw_tx_data
+    Find out what a cell holds by running it through the cleaners of
+    tx_data
+    Return: "date", "amount", "text" or "" (empty or anything else)
     """
-    # we need some class constants for the date format as this
-    # seems to be quite messy
-    DATE_FORMAT_DAY_FIRST = True
-    ANALYSIS_START_DATE = datetime(2000, 1, 1)
-    ANALYSIS_END_DATE = datetime.today()
+    value = str(value).strip()
+    if not value:
+        return ""
 
-    subscriptions_data = []
-    recurring_merchants_data = []
+    # the date format of the data isn't known yet, so both are tried
+    for day_first in (True, False):
+        tx_data.DATE_FORMAT_DAY_FIRST = day_first
+        if tx_data.clean_date(value):
+            return "date"
 
-    def __init__(self):
-        self.sorted_clean_data = []
-        self.clean_tx_data = []
+    if tx_data.clean_amount(value) is not False:
+        return "amount"
 
-    def check_date_format(self, data):
-        """
-        Check the date format manually as parser.parse is trying convert
-        the date and if the month value is to high because it is a day
-        then it just switches and takes the smaler value as the month
-        Sets the class constant DATE_FORMAT_DAY_FIRST to True or False
-        """
-        print("\nChecking the date format of the input data...\n")
+    # merchants need at least one letter
+    if re.search(r"[^\W\d_]", value) and tx_data.clean_merchant(value):
+        return "text"
 
-        for row in data:
-            date_str = row[TX_DATE_KEY]
+    return ""
 
-            try:
-                # let's check if we can deconstruct the date string
-                # Regular expression to match dates with '.', '/', or
-                # '-' provided by ChatGPT
+
+def get_column_share(cell_types, col, cell_type):
+    """
+    Return: share of the rows of cell_types whose cell in column col
+    is of cell_type
+    """
+    if not cell_types:
+        return 0
+
+    matches = sum(1 for types in cell_types
+                  if col < len(types) and types[col] == cell_type)
+    return matches / len(cell_types)
+
+
+def get_sample_rows(raw_data_wsheet):
+    """
+    Read the first SCHEMA_SAMPLE_ROWS rows of the worksheet
+    Return: list of lists, empty in case of any error
+    """
+    try:
+        return raw_data_wsheet.get(f"1:{SCHEMA_SAMPLE_ROWS}")
+
+    except (APIError, GSpreadException) as e:
+        print(f"\nRET couldn't read the first rows of the worksheet: {e}")
+        return []
+
+
+def infer_schema(sample_rows):
+    """
+    Recognise the transaction data in sample_rows: the data starts in
+    the first row with a date and an amount. From there on the column
+    with the most dates is the date column, the column with the most
+    amounts the amount column and the text column with the most
+    different values the merchant column (the leftmost column wins a
+    tie). Each of them needs a share of at least SCHEMA_MIN_SHARE
+    Return: start row, zero-based date, merchant and amount columns or
+    False if the data can't be recognised
+    """
+    tx_data = TxData()
+    cell_types = [[get_cell_type(tx_data, value) for value in row]
+                  for row in sample_rows]
+
+    start = next((r for r, types in enumerate(cell_types)
+                  if "date" in types and "amount" in types), None)
+    if start is None:
+        return False
+
+    # empty rows don't count
+    data_rows = [row for row in sample_rows[start:] if any(row)]
+    data_types = [types for types in cell_types[start:] if any(types)]
+    num_cols = max(len(types) for types in data_types)
+
+    def distinct_values(col):
+        return len({row[col] for row in data_rows if col < len(row)})
+
+    columns = {}
+    for key, cell_type in ((TX_DATE_KEY, "date"),
+                           (TX_AMOUNT_KEY, "amount"),
+                           (TX_MERCHANT_KEY, "text")):
+        candidates = [col for col in range(num_cols)
+                      if col not in columns.values()
+                      and get_column_share(data_types, col, cell_type) >=
+                      SCHEMA_MIN_SHARE]
+        if not candidates:
+            return False
+
+        if cell_type == "text":
+            columns[key] = max(candidates,
+                               key=lambda col: (distinct_values(col), -col))
+        else:
+            columns[key] = max(candidates, key=lambda col: (
+                get_column_share(data_types, col, cell_type), -col))
+
+    return (start + 1, columns[TX_DATE_KEY], columns[TX_MERCHANT_KEY],
+            columns[TX_AMOUNT_KEY])
+
+
+def check_schema(schema, sample_rows):
+    """
+    Check the start row and columns entered by the user against
+    sample_rows
+    Return: list of problems, empty if the columns look right
+    """
+    start_row, tx_date_col, tx_merchant_col, tx_amount_col = schema
+    tx_data = TxData()
+    data_types = [
+        [get_cell_type(tx_data, value) for value in row]
+        for row in sample_rows[start_row - 1:] if any(row)
+        ]
+    # nothing to check if the sample couldn't be read
+    if not data_types:
+        return []
+
+    problems = []
+    for col, cell_type, name in ((tx_date_col, "date", "date"),
+                                 (tx_merchant_col, "text", "merchant"),
+                                 (tx_amount_col, "amount", "amount")):
+        share = get_column_share(data_types, col, cell_type)
+        if share < SCHEMA_MIN_SHARE:
+            problems.append(
+                f"Only {share:.0%} of the first rows in column "
+                f"{column_number_to_letter(col + 1)} look like a {name}.")
+
+    return problems
+
+
+def confirm_schema(schema, sample_rows):
+    """
+    Show the recognised start row and columns with the first row of
+    data and ask the user to confirm them
+    Return: True if the user confirms
+    """
+    start_row, tx_date_col, tx_merchant_col, tx_amount_col = schema
+    first_row = sample_rows[start_row - 1]
+    # the row above the data usually holds the headings
+    headings = sample_rows[start_row - 2] if start_row > 1 else []
+
+    print("\nRET has recognised your transaction data:\n")
+    print(f"The data starts in row {start_row}.")
+    for col, name in ((tx_date_col, "Date"),
+                      (tx_merchant_col, "Merchant"),
+                      (tx_amount_col, "Amount")):
+        heading = headings[col] if col < len(headings) else ""
+        example = first_row[col] if col < len(first_row) else ""
+        print(f"{name + ':':<10} column {column_number_to_letter(col + 1):<3}"
+              f" {heading:<20} e.g. {example}")
+
+    confirm = input("\nDo you want RET to use these columns? (y/n):\n")
+    return confirm.strip().lower() == "y"
+
+
+#################################################################
+# BINARY TRANSACTION FILE                                       #
+#################################################################
+# layout of a .rettx file (all values in native byte order):
+#   header:   magic, version, amount exponent, number of rows,
+#             number of merchants (see TX_BINARY_HEADER)
+#   columns:  amount in cents (int64), date ordinal (int32),
+#             merchant id (int32), row number (int32)
+#   merchant string table: offsets (int32, num_merchants + 1)
+#             followed by the utf-8 encoded merchant names
+TX_BINARY_MAGIC = b"RETTX\x00\x00\x01"
+TX_BINARY_VERSION = 1
+TX_BINARY_HEADER = struct.Struct("=8sIIQQ")
+
+
+def tx_binary_file_name(raw_data_wsheet):
+    """
+    Build the file name of the binary transaction file for the
+    worksheet the user imported the CSV file to
+    """
+    file_name = f"{tx_account_key(raw_data_wsheet)}.rettx"
+    return os.path.join(TX_BINARY_DIR, file_name)
+
+
+def write_tx_binary(file_name, clean_tx_data):
+    """
+    Write the cleaned transaction data into a compact binary file
+    so it can be reloaded later without parsing any strings again
+    Return: True if the file was written, False in case of any error
+    """
+    try:
+        merchant_ids = {}
+        merchant_col = array("i")
+        date_col = array("i")
+        amount_col = array("q")
+        row_col = array("i")
+
+        for row in clean_tx_data:
+            merchant = row[TX_MERCHANT_KEY]
+            if merchant not in merchant_ids:
+                merchant_ids[merchant] = len(merchant_ids)
+            merchant_col.append(merchant_ids[merchant])
+            date_col.append(row[TX_DATE_KEY].toordinal())
+            amount_col.append(row[TX_AMOUNT_KEY])
+            row_col.append(row[ROW_KEY])
+
+        # the merchant string table: one offset per merchant into the blob
+        # of utf-8 encoded names plus the end offset of the last name
+        name_blob = bytearray()
+        name_offsets = array("i", [0])
+        for merchant in merchant_ids:
+            name_blob += merchant.encode("utf-8")
+            name_offsets.append(len(name_blob))
+
+        header = TX_BINARY_HEADER.pack(TX_BINARY_MAGIC, TX_BINARY_VERSION,
+                                       CURRENCY_EXPONENT, len(clean_tx_data),
+                                       len(merchant_ids))
+
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        # write to a temporary file first so a half written file never
+        # replaces a good one
+        with open(file_name + ".tmp", "wb") as tx_file:
+            tx_file.write(header)
+            tx_file.write(amount_col.tobytes())
+            tx_file.write(date_col.tobytes())
+            tx_file.write(merchant_col.tobytes())
+            tx_file.write(row_col.tobytes())
+            tx_file.write(name_offsets.tobytes())
+            tx_file.write(name_blob)
+        os.replace(file_name + ".tmp", file_name)
+
+        return True
+
+    except OSError as e:
+        print(f"\nRET couldn't save the cleaned transaction data: {e}")
+        return False
+
+
+class TxBinaryFile:
+    """
+    Read only access to a binary transaction file written by
+    write_tx_binary(). The file is memory-mapped and the columns are
+    memoryviews on the mapping, so nothing is copied or parsed
+    Input: file name of the .rettx file
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, "rb") as tx_file:
+            self.mapping = mmap.mmap(tx_file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+
+        (magic, version, self.amount_exponent, self.num_rows,
+         num_merchants) = TX_BINARY_HEADER.unpack_from(self.mapping, 0)
+        if magic != TX_BINARY_MAGIC or version != TX_BINARY_VERSION:
+            self.mapping.close()
+            raise ValueError(f"'{file_name}' is not a RET transaction file.")
+        if self.amount_exponent != CURRENCY_EXPONENT:
+            self.mapping.close()
+            raise ValueError(f"'{file_name}' was saved with a different \
+                             currency exponent.")
+
+        view = memoryview(self.mapping)
+        offset = TX_BINARY_HEADER.size
+        n = self.num_rows
+
+        self.amounts = view[offset:offset + 8 * n].cast("q")
+        offset += 8 * n
+        self.dates = view[offset:offset + 4 * n].cast("i")
+        offset += 4 * n
+        self.merchant_ids = view[offset:offset + 4 * n].cast("i")
+        offset += 4 * n
+        self.rows = view[offset:offset + 4 * n].cast("i")
+        offset += 4 * n
+
+        name_offsets = view[offset:offset + 4 * (num_merchants + 1)].cast("i")
+        offset += 4 * (num_merchants + 1)
+        # the merchant names are the only part we need to decode and
+        # there is only one per merchant
+        self.merchants = [
+            str(view[offset + name_offsets[i]:offset + name_offsets[i+1]],
+                "utf-8")
+            for i in range(num_merchants)
+            ]
+        name_offsets.release()
+
+    def get_source_hash(self):
+        """
+        Hash the file content straight from the mapping, so the result
+        cache can be checked without converting any row (see
+        get_source_hash for the rows of a fresh import)
+        Returns: hex string
+        """
+        return hashlib.sha256(self.mapping).hexdigest()
+
+    def to_clean_tx_data(self):
+        """
+        Convert the columns back into the list of dictionaries used by
+        the analysis. This is the expensive part of a reload (about a
+        second per million rows), so each date is only converted once
+        and the columns are copied into lists in one step each
+        Return: clean_tx_data
+        """
+        merchants = self.merchants
+        dates = self.dates.tolist()
+        tx_dates = {date: datetime.fromordinal(date) for date in set(dates)}
+
+        return [
+            {
+                ROW_KEY: row,
+                TX_DATE_KEY: tx_dates[date],
+                TX_MERCHANT_KEY: merchants[merchant_id],
+                TX_AMOUNT_KEY: amount
+                }
+            for row, date, merchant_id, amount in zip(
+                self.rows.tolist(), dates, self.merchant_ids.tolist(),
+                self.amounts.tolist())
+            ]
+
+    def close(self):
+        """
+        Release the column views and unmap the file
+        """
+        for column in (self.amounts, self.dates, self.merchant_ids,
+                       self.rows):
+            column.release()
+        self.mapping.close()
+
+
+def open_tx_binary(file_name):
+    """
+    Open a binary transaction file
+    Return: TxBinaryFile, False in case of any error
+    """
+    try:
+        return TxBinaryFile(file_name)
+
+    except (OSError, ValueError) as e:
+        print(f"\nRET couldn't reload the cleaned transaction data: {e}")
+        return False
+
+
+def load_tx_binary(file_name):
+    """
+    Reload the cleaned transaction data from a binary file
+    Return: clean_tx_data, False in case of any error
+    """
+    tx_file = open_tx_binary(file_name)
+    if not tx_file:
+        return False
+
+    try:
+        return tx_file.to_clean_tx_data()
+    finally:
+        tx_file.close()
+
+
+#################################################################
+# SQLITE TRANSACTION STORE                                      #
+#################################################################
+TX_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS merchants (
+    merchant_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    account TEXT NOT NULL,
+    merchant_id INTEGER NOT NULL REFERENCES merchants (merchant_id),
+    tx_date INTEGER NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    dup_seq INTEGER NOT NULL,
+    row INTEGER,
+    PRIMARY KEY (account, merchant_id, tx_date, amount_cents, dup_seq)
+) WITHOUT ROWID;
+"""
+
+
+def tx_account_key(raw_data_wsheet):
+    """
+    Build the key RET uses for the transaction data of a worksheet
+    """
+    return f"{raw_data_wsheet.spreadsheet_id}_{raw_data_wsheet.id}"
+
+
+def open_tx_store(file_name=TX_STORE_FILE):
+    """
+    Open (and create if needed) the SQLite transaction store
+    Return: the sqlite3 connection, False in case of any error
+    """
+    try:
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        store = sqlite3.connect(file_name)
+        store.executescript(TX_STORE_SCHEMA)
+        return store
+
+    except (OSError, sqlite3.Error) as e:
+        print(f"\nRET couldn't open the transaction store: {e}")
+        return False
+
+
+def save_tx_data_to_store(store, account, clean_tx_data):
+    """
+    Replace the transaction data of account in the store with the
+    cleaned transaction data of this import, so rows deleted or edited
+    in the worksheet since an earlier run aren't analyzed again.
+    Identical transactions on the same day are numbered (dup_seq)
+    Return: number of rows written, False in case of any error
+    """
+    try:
+        # one transaction for the whole import, commits on success
+        # and rolls back on any error
+        with store:
+            store.executemany(
+                "INSERT OR IGNORE INTO merchants (name) VALUES (?)",
+                ((merchant,) for merchant in dict.fromkeys(
+                    row[TX_MERCHANT_KEY] for row in clean_tx_data))
+                )
+            merchant_ids = dict(store.execute(
+                "SELECT name, merchant_id FROM merchants"))
+
+            dup_counts = {}
+            tx_rows = []
+            for row in clean_tx_data:
+                tx_key = (merchant_ids[row[TX_MERCHANT_KEY]],
+                          row[TX_DATE_KEY].toordinal(),
+                          row[TX_AMOUNT_KEY])
+                dup_seq = dup_counts.get(tx_key, 0)
+                dup_counts[tx_key] = dup_seq + 1
+                tx_rows.append((account, *tx_key, dup_seq, row[ROW_KEY]))
+
+            store.execute("DELETE FROM transactions WHERE account = ?",
+                          (account,))
+            store.executemany(
+                """INSERT INTO transactions
+                   (account, merchant_id, tx_date, amount_cents, dup_seq, row)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                tx_rows)
+
+        return len(tx_rows)
+
+    except sqlite3.Error as e:
+        print(f"\nRET couldn't save the transaction data to the store: {e}")
+        return False
+
+
+def query_merchant_tx(store, account, merchant, start_date, end_date):
+    """
+    Get all transactions of account at merchant between start_date
+    (inclusive) and end_date (exclusive), e.g. all charges at netflix
+    last year. The primary key (account, merchant_id, tx_date, ...) is
+    the index serving it, so no separate (merchant_id, tx_date) index
+    is needed
+    Return: list of dictionaries sorted by date, False in case of any error
+    """
+    try:
+        store_rows = store.execute(
+            """SELECT t.row, t.tx_date, m.name, t.amount_cents
+               FROM merchants m
+               JOIN transactions t ON t.merchant_id = m.merchant_id
+               WHERE m.name = ? AND t.account = ?
+                     AND t.tx_date >= ? AND t.tx_date < ?
+               ORDER BY t.tx_date""",
+            (merchant, account, start_date.toordinal(),
+             end_date.toordinal()))
+        return store_rows_to_tx_data(store_rows)
+
+    except sqlite3.Error as e:
+        print(f"\nRET couldn't query the transaction store: {e}")
+        return False
+
+
+def store_rows_to_tx_data(store_rows):
+    """
+    Convert (row, tx_date, name, amount_cents) tuples from the store
+    into the list of dictionaries used by the analysis
+    """
+    return [
+        {
+            ROW_KEY: row,
+            TX_DATE_KEY: datetime.fromordinal(tx_date),
+            TX_MERCHANT_KEY: merchant,
+            TX_AMOUNT_KEY: amount_cents
+            }
+        for row, tx_date, merchant, amount_cents in store_rows
+        ]
+
+
+#################################################################
+# RESULT CACHE                                                  #
+#################################################################
+def get_source_hash(rows):
+    """
+    Build the content hash of the rows an analysis run starts from:
+    the raw selection from the worksheet or the reloaded clean data
+    Returns: hex string
+    """
+    source_hash = hashlib.sha256()
+    for row in rows:
+        source_hash.update(repr((row[ROW_KEY], row[TX_DATE_KEY],
+                                 row[TX_MERCHANT_KEY],
+                                 row[TX_AMOUNT_KEY])).encode("utf-8"))
+
+    return source_hash.hexdigest()
+
+
+def get_result_hash(tx_data, aliases):
+    """
+    Build the content hash of an analysis run: the hash of its source
+    rows (tx_data.source_hash), the merchant aliases and every setting
+    the cleaning and the detection depend on
+    Returns: hex string
+    """
+    result_hash = hashlib.sha256()
+
+    settings = (RESULT_CACHE_VERSION, CURRENCY_EXPONENT, tx_data.subs_day_flex,
+                tx_data.subs_amount_flex, SUBS_CADENCES, SUBS_CONFIDENT_GAPS,
+                SUBS_MIN_CONFIDENCE, FORECAST_MONTHS, REFUND_MAX_DAYS,
+                DUPLICATE_MAX_DAYS, DUPLICATE_AMOUNT_FLEX,
+                ROLLING_WINDOW_MONTHS,
+                [(pattern.pattern, replacement)
+                 for pattern, replacement in MERCHANT_RULES],
+                MERCHANT_CLUSTERING_ENABLED, MERCHANT_CLUSTER_THRESHOLD,
+                MERCHANT_CLUSTER_MIN_NGRAMS,
+                tx_data.as_of_date and tx_data.as_of_date.toordinal(),
+                tx_data.category_classifier and
+                tx_data.category_classifier.rules_hash)
+    result_hash.update(repr(settings).encode("utf-8"))
+    result_hash.update(tx_data.source_hash.encode("utf-8"))
+    if MERCHANT_CLUSTERING_ENABLED:
+        result_hash.update(json.dumps(aliases, sort_keys=True).encode(
+            "utf-8"))
+
+    return result_hash.hexdigest()
+
+
+def load_cached_result(result_hash):
+    """
+    Look up the analysis result for result_hash in the result cache
+    Returns: dictionary of the RESULT_CACHE_ATTRIBUTES or False if the
+    result is not in the cache
+    """
+    file_name = os.path.join(RESULT_CACHE_DIR, f"{result_hash}.pickle")
+
+    try:
+        with open(file_name, "rb") as cache_file:
+            cached_result = pickle.load(cache_file)
+        # mark the entry as recently used for the LRU eviction
+        os.utime(file_name)
+        return cached_result
+
+    except FileNotFoundError:
+        return False
+
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        print(f"\nRET couldn't read the cached result: {e}")
+        return False
+
+
+def save_cached_result(result_hash, tx_data):
+    """
+    Store the RESULT_CACHE_ATTRIBUTES of tx_data in the result cache and
+    evict the least recently used results until the cache fits
+    RESULT_CACHE_MAX_BYTES
+    """
+    file_name = os.path.join(RESULT_CACHE_DIR, f"{result_hash}.pickle")
+
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        with open(file_name + ".tmp", "wb") as cache_file:
+            pickle.dump({attribute: getattr(tx_data, attribute)
+                         for attribute in RESULT_CACHE_ATTRIBUTES},
+                        cache_file)
+        os.replace(file_name + ".tmp", file_name)
+
+        cache_entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(RESULT_CACHE_DIR)
+            if entry.name.endswith(".pickle")
+            )
+        cache_size = sum(size for mtime, size, path in cache_entries)
+        for mtime, size, path in cache_entries:
+            if cache_size <= RESULT_CACHE_MAX_BYTES or path == file_name:
+                break
+            os.remove(path)
+            cache_size -= size
+
+        return True
+
+    except OSError as e:
+        print(f"\nRET couldn't cache the result: {e}")
+        return False
+
+
+def load_result_of_source(tx_data, account, source_hash):
+    """
+    Load the result of exactly the rows with source_hash (the rows the
+    analysis of account starts from) and the current settings from the
+    result cache into tx_data, so nothing has to be cleaned, sorted or
+    analyzed
+    Sets: tx_data.source_hash and, if found, tx_data.result_hash
+    Returns: True if the result was in the cache
+    """
+    tx_data.source_hash = source_hash
+    result_hash = get_result_hash(
+        tx_data, load_merchant_aliases(merchant_alias_file_name(account)))
+    cached_result = load_cached_result(result_hash)
+    if not cached_result:
+        return False
+
+    for attribute, value in cached_result.items():
+        setattr(tx_data, attribute, value)
+    tx_data.result_hash = result_hash
+    return True
+
+
+def worksheet_holds_result(spreadsheet, worksheet_name, result_hash):
+    """
+    Check if the worksheet worksheet_name already holds the result with
+    result_hash (written to RESULT_HASH_CELL by the results upload)
+    """
+    try:
+        ws_output = spreadsheet.worksheet(worksheet_name)
+        return ws_output.acell(RESULT_HASH_CELL).value == result_hash
+
+    except (gspread.exceptions.WorksheetNotFound, APIError):
+        return False
+
+
+#################################################################
+# VALIDATION REPORT                                             #
+#################################################################
+class ValidationReport:
+    """
+    Collects the values the cleaners rejected while cleaning the
+    transaction data, instead of printing a message for every row
+    One entry per rejected value: row number, column, raw value and
+    error class, plus a count per (column, error class)
+    """
+
+    def __init__(self):
+        self.rows = array("i")
+        self.columns = []
+        self.raw_values = []
+        self.error_classes = []
+        self.error_counts = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row, column, raw_value, error_class):
+        """
+        Record one rejected value
+        """
+        self.rows.append(row)
+        self.columns.append(column)
+        self.raw_values.append(raw_value)
+        self.error_classes.append(error_class)
+        count_key = (column, error_class)
+        self.error_counts[count_key] = self.error_counts.get(count_key, 0) + 1
+
+    def print_summary(self, num_rows):
+        """
+        Print one summary of all rejected values
+        """
+        if not self.rows:
+            return
+
+        cprint(f"\nRET rejected {len(self.rows)} of {num_rows} rows:",
+               'red')
+        for (column, error_class), count in sorted(self.error_counts.items()):
+            print(f"{count:>7} x {error_class} in {column}")
+
+    def get_quarantine_rows(self):
+        """
+        Return: the rejected values as worksheet rows incl. headings
+        """
+        keys_list = [ROW_KEY, "column", "raw_value", "error_class"]
+        return [keys_list] + [
+            list(entry) for entry in zip(self.rows, self.columns,
+                                         self.raw_values, self.error_classes)
+            ]
+
+
+def upload_quarantine_to_worksheet(spreadsheet, worksheet_name, report):
+    """
+    create a new worksheet with worksheet_name in spreadsheet and
+    write all rejected rows of the validation report in a single write
+    """
+    try:
+        quarantine_rows = report.get_quarantine_rows()
+        ws_output = spreadsheet.add_worksheet(
+            title=worksheet_name, rows=len(quarantine_rows), cols=4)
+        # RAW so the rejected values show exactly as they were imported
+        ws_output.update(quarantine_rows, "A1", value_input_option='RAW')
+        format_row_in_worksheet(ws_output, 1, "bold")
+
+        print(f"\nThe rejected rows have been uploaded to Spreadsheet: \
+                \n'{spreadsheet.title}' | worksheet: '{worksheet_name}'")
+        return True
+
+    except APIError as e:
+        if e.response.status_code == 400:
+            new_worksheet_name = get_new_worksheet_name(spreadsheet,
+                                                        worksheet_name)
+            return upload_quarantine_to_worksheet(spreadsheet,
+                                                  new_worksheet_name, report)
+
+        print(f"\nAn API error occurred: {e}")
+        return False
+
+    except GSpreadException as e:
+        print(f"\nAn error occurred trying to access the spreadsheet: {e}")
+        return False
+
+
+def offer_quarantine(spreadsheet, report):
+    """
+    Offer to write the rejected rows of the validation report to the
+    QUARANTINE worksheet, or to QUARANTINE_FILE if the upload fails
+    """
+    if not report:
+        return
+
+    quarantine = input("\nDo you want RET to write the rejected \
+                       \nrows to a worksheet? (y/n):\n")
+    if quarantine.strip().lower() == "y":
+        if not upload_quarantine_to_worksheet(spreadsheet, "QUARANTINE",
+                                              report):
+            write_quarantine_file(QUARANTINE_FILE, report)
+
+
+def write_quarantine_file(file_name, report):
+    """
+    Write all rejected rows of the validation report to a CSV file
+    """
+    try:
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        with open(file_name, "w", newline="") as quarantine_file:
+            csv.writer(quarantine_file).writerows(
+                report.get_quarantine_rows())
+
+        print(f"\nThe rejected rows have been saved to: {file_name}")
+        return True
+
+    except OSError as e:
+        print(f"\nRET couldn't save the rejected rows: {e}")
+        return False
+
+
+#################################################################
+# MERCHANT NORMALIZATION                                        #
+#################################################################
+def normalize_merchant(merchant_str):
+    """
+    Normalize a merchant name with MERCHANT_RULES, so that e.g.
+    "NETFLIX.COM 8472", "Netflix.com*AB12" and "netflix" all become
+    "netflix". The name is cut at the first ',' or ';'
+    Return: normalized name, empty string if nothing is left
+    """
+    merchant = merchant_str.lower()
+    merchant = merchant.split(",")[0]
+    merchant = merchant.split(";")[0]
+    merchant = merchant.strip()
+
+    for pattern, replacement in MERCHANT_RULES:
+        merchant = pattern.sub(replacement, merchant)
+
+    # let's not end up with an empty name just because the name looked
+    # like a reference, e.g. "7-11"
+    return merchant.strip(" -_.:/") or merchant_str.strip().lower()
+
+
+#################################################################
+# MERCHANT CLUSTERING                                           #
+#################################################################
+def merchant_ngrams(merchant):
+    """
+    Return: set of the character trigrams of the padded merchant name
+    """
+    padded = f" {merchant} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def cluster_merchants(merchants, tx_counts, canonicals=()):
+    """
+    Group merchant names that are variants of each other, e.g.
+    "spotify ab" and "spotify stockholm". Candidate pairs are found
+    through an inverted index of the character trigrams, so not every
+    pair of names has to be compared. Two names are merged if they
+    start the same and at least MERCHANT_CLUSTER_THRESHOLD of the
+    trigrams of the shorter one are found in the other one
+    merchants: list of distinct merchant names
+    tx_counts: number of transactions per merchant name
+    canonicals: names that are already canonical names from a
+    previous run and are preferred as the name of a group
+    Return: dictionary merchant: canonical name of its group
+    """
+    canonicals = set(canonicals)
+    # let's index the canonical names first
+    merchants = sorted(merchants, key=lambda merchant:
+                       merchant not in canonicals)
+    ngrams = [merchant_ngrams(merchant) for merchant in merchants]
+    # union-find over the merchant indices
+    parent = list(range(len(merchants)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # only names starting with the same two characters can be merged,
+    # so the trigrams are indexed per first two characters
+    postings = {}
+    for i, merchant_ngram in enumerate(ngrams):
+        block = merchants[i][:2]
+        # canonical names of a previous run weren't similar enough to
+        # each other, they only need to be compared with the new names
+        if len(merchant_ngram) >= MERCHANT_CLUSTER_MIN_NGRAMS and \
+                merchants[i] not in canonicals:
+            # let's count the trigrams the earlier names share with this
+            # name, skipping the trigrams most names have
+            shared = Counter()
+            num_skipped = 0
+            for ngram in merchant_ngram:
+                posting = postings.get((block, ngram), ())
+                if len(posting) > MERCHANT_NGRAM_MAX_POSTINGS:
+                    num_skipped += 1
+                else:
+                    shared.update(posting)
+
+            for j, num_shared in shared.items():
+                min_ngrams = min(len(merchant_ngram), len(ngrams[j]))
+                required = MERCHANT_CLUSTER_THRESHOLD * min_ngrams
+                if min_ngrams < MERCHANT_CLUSTER_MIN_NGRAMS or \
+                        num_shared + num_skipped < required or \
+                        find(i) == find(j):
+                    continue
+                # the skipped trigrams may or may not be shared
+                if len(merchant_ngram & ngrams[j]) >= required:
+                    parent[find(i)] = find(j)
+
+        for ngram in merchant_ngram:
+            postings.setdefault((block, ngram), []).append(i)
+
+    groups = {}
+    for i in range(len(merchants)):
+        groups.setdefault(find(i), []).append(merchants[i])
+
+    # the group is named after a canonical name of a previous run or
+    # otherwise its most used (and then shortest) name
+    aliases = {}
+    for group in groups.values():
+        canonical = min(group, key=lambda merchant: (
+            merchant not in canonicals, -tx_counts.get(merchant, 0),
+            len(merchant), merchant))
+        for merchant in group:
+            aliases[merchant] = canonical
+
+    return aliases
+
+
+def merchant_alias_file_name(account):
+    """
+    Build the file name of the merchant alias map of account, so a
+    merge accepted for one worksheet doesn't rename the merchants of
+    another one
+    """
+    return os.path.join(MERCHANT_ALIAS_DIR, f"{account}.json")
+
+
+def load_merchant_aliases(file_name):
+    """
+    Load the merchant alias map saved by a previous run
+    Return: dictionary merchant: canonical name, empty if there is none
+    or it was built with other settings
+    """
+    try:
+        with open(file_name) as json_file:
+            saved = json.load(json_file)
+
+        if saved["threshold"] == MERCHANT_CLUSTER_THRESHOLD and \
+                saved["min_ngrams"] == MERCHANT_CLUSTER_MIN_NGRAMS:
+            return saved["aliases"]
+
+    except FileNotFoundError:
+        pass
+
+    except (OSError, ValueError, KeyError) as e:
+        print(f"\nRET couldn't load the merchant aliases: {e}")
+
+    return {}
+
+
+def save_merchant_aliases(file_name, aliases):
+    """
+    Save the merchant alias map for the next run
+    """
+    try:
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        with open(file_name + ".tmp", "w") as json_file:
+            json.dump({
+                "threshold": MERCHANT_CLUSTER_THRESHOLD,
+                "min_ngrams": MERCHANT_CLUSTER_MIN_NGRAMS,
+                "aliases": aliases
+                }, json_file)
+        os.replace(file_name + ".tmp", file_name)
+
+    except OSError as e:
+        print(f"\nRET couldn't save the merchant aliases: {e}")
+
+
+def merge_merchant_aliases(clean_tx_data, alias_file):
+    """
+    Replace the merchant names of clean_tx_data with the canonical name
+    of their group. Names known from previous runs are looked up in the
+    saved alias map, only new names are clustered (together with the
+    known canonical names) and then added to the map
+    Return: number of merchants merged into another one
+    """
+    aliases = load_merchant_aliases(alias_file)
+
+    tx_counts = {}
+    for row in clean_tx_data:
+        merchant = row[TX_MERCHANT_KEY]
+        tx_counts[merchant] = tx_counts.get(merchant, 0) + 1
+
+    new_merchants = [merchant for merchant in tx_counts
+                     if merchant not in aliases]
+    if new_merchants:
+        canonicals = list(dict.fromkeys(aliases.values()))
+        new_aliases = cluster_merchants(new_merchants + canonicals,
+                                        tx_counts, canonicals)
+        # a new name can join two known groups, so let's point their
+        # names to the canonical name of the joined group
+        for merchant, canonical in aliases.items():
+            aliases[merchant] = new_aliases[canonical]
+        aliases.update(new_aliases)
+        save_merchant_aliases(alias_file, aliases)
+
+    for row in clean_tx_data:
+        row[TX_MERCHANT_KEY] = aliases[row[TX_MERCHANT_KEY]]
+
+    return sum(1 for merchant in tx_counts if aliases[merchant] != merchant)
+
+
+#################################################################
+# CATEGORY CLASSIFIER                                           #
+#################################################################
+class CategoryClassifier:
+    """
+    Finds the spending category of merchant names. All keywords are
+    compiled once into an Aho-Corasick automaton, so a name is
+    classified in a single pass over its characters no matter how many
+    rules there are. Keywords only match whole words and the longest
+    matching keyword wins, e.g. "amazon prime" before "amazon"
+    Input: list of (keyword, category) tuples, earlier rules win ties
+    """
+
+    def __init__(self, rules):
+        # the trie: goto transitions, fail links and per state the
+        # (length, rule number, category) of the keywords ending there
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        self.rules_hash = hashlib.sha256(
+            repr(rules).encode("utf-8")).hexdigest()
+
+        for rule_number, (keyword, category) in enumerate(rules):
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.outputs[state].append((len(keyword), rule_number,
+                                        category))
+
+        # breadth first, so the fail link of the parent is always ready
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + \
+                    self.outputs[self.fail[next_state]]
+                queue.append(next_state)
+
+    def classify(self, merchant):
+        """
+        Return: category of the longest keyword found in merchant,
+        CATEGORY_UNKNOWN if there is none
+        """
+        best_match = (0, 0, CATEGORY_UNKNOWN)
+        state = 0
+
+        for end, char in enumerate(merchant, 1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+
+            for length, rule_number, category in self.outputs[state]:
+                start = end - length
+                # whole words only
+                if (start > 0 and merchant[start - 1].isalnum()) or \
+                        (end < len(merchant) and merchant[end].isalnum()):
+                    continue
+                if (length, -rule_number) > best_match[:2]:
+                    best_match = (length, -rule_number, category)
+
+        return best_match[2]
+
+
+def load_category_classifier(file_name):
+    """
+    Load the keyword,category rules from file_name (csv with a heading
+    row) and compile them
+    Return: CategoryClassifier, False in case of any error
+    """
+    try:
+        with open(file_name, newline="", encoding="utf-8") as csv_file:
+            reader = csv.reader(csv_file)
+            next(reader, None)
+            rules = [(keyword.strip().lower(), category.strip())
+                     for keyword, category in reader if keyword.strip()]
+
+        return CategoryClassifier(rules)
+
+    except (OSError, ValueError) as e:
+        print(f"\nRET couldn't load the merchant categories: {e}")
+        return False
+
+
+#################################################################
+# SUBSCRIPTION DETECTION                                        #
+#################################################################
+def days_in_month(tx_date):
+    """
+    Return: number of days of the month of tx_date
+    """
+    if tx_date.month == 2 and calendar.isleap(tx_date.year):
+        return 29
+    return calendar.mdays[tx_date.month]
+
+
+def get_cadence(gap, prev_day, prev_num_days, curr_day, day_flex):
+    """
+    Find the cadence in SUBS_CADENCES that the gap (in days) between
+    two transactions fits. Day based cadences allow +- day_flex but at
+    most a seventh of their length. Month based cadences allow any
+    length of the months +- day_flex, but the transactions also have
+    to happen on the same day of the month +- day_flex
+    Return: index of the cadence in SUBS_CADENCES, -1 if none fits
+    """
+    # let's make sure we stay in the same months when comparing
+    # the dates from:
+    # https://www.askpython.com/python/examples/find-number-of-days-in-month
+    if prev_day - day_flex <= 0:
+        prev_day = 1
+    elif prev_day + day_flex >= prev_num_days:
+        prev_day = prev_num_days
+    same_day = abs(curr_day - prev_day) <= day_flex
+
+    for cadence, (name, cadence_days, cadence_months) in enumerate(
+            SUBS_CADENCES):
+        if cadence_days:
+            if abs(gap - cadence_days) <= min(day_flex, cadence_days // 7):
+                return cadence
+        elif same_day and cadence_months * 28 - day_flex <= gap <= \
+                cadence_months * 31 + day_flex:
+            return cadence
+
+    return -1
+
+
+def is_subs_active(sub_end_date, end_date, subs_frequency):
+    """
+    check if a subs paid every subs_frequency is active at end_date or
+    ended in the past: it is active as long as its next payment after
+    sub_end_date isn't due yet
+    returns: true or false
+    """
+    for name, cadence_days, cadence_months in SUBS_CADENCES:
+        if name == subs_frequency:
+            break
+    else:
+        cadence_days, cadence_months = 0, 1
+
+    if cadence_days:
+        return end_date.toordinal() - sub_end_date.toordinal() < \
+            cadence_days
+
+    # months are counted across years, so December is the month
+    # before January
+    months_before = month_index(end_date) - month_index(sub_end_date)
+
+    if sub_end_date.day > end_date.day:
+        # if the sub_end_date day is later in the month than the
+        # end_date the next payment is due in the month of end_date
+        # if the subs tx happened one period before
+        return months_before <= cadence_months
+
+    # ok if the subs was active its next payment would have happened
+    # on or before end_date in the month one period later
+    return months_before < cadence_months
+
+
+def find_subscription_runs(days, num_days, ordinals, amounts, amount_order,
+                           start, end, day_flex, amount_flex):
+    """
+    Find the subscription streams among the transactions start to end
+    of one merchant (sorted by date in reverse order). The columns hold
+    per transaction: day of the month, number of days of its month,
+    date ordinal and amount in minor units. amount_order holds the
+    indices start to end sorted by amount
+    The transactions are first split into amount bands: sorted by
+    amount, a new band starts where the next amount is more than
+    amount_flex higher. Every band is then checked on its own, so
+    subscriptions of different amounts at the same merchant (e.g. two
+    apps billed by apple) don't get in the way of each other
+    Within a band, the gaps between consecutive transactions are
+    counted per cadence (see get_cadence) and the most common cadence
+    is the period of the band. Runs of consecutive transactions with
+    this period are subscription streams. The confidence of a stream
+    is the share of the band's gaps that fit the period, reduced for
+    streams with fewer than SUBS_CONFIDENT_GAPS gaps. Streams below
+    SUBS_MIN_CONFIDENCE and everything else is irregular and left to
+    the recurring merchants
+    A price change moves the payments of a subscription into another
+    band, so a stream that continues an older stream of the same
+    cadence one period after its last payment is joined to it
+    Returns: list of (indices of the stream newest first, cadence name,
+    confidence)
+    """
+    bands = []
+    band = [amount_order[start]]
+    for k in range(start + 1, end):
+        i = amount_order[k]
+        if amounts[i] - amounts[band[-1]] > amount_flex:
+            bands.append(band)
+            band = []
+        band.append(i)
+    bands.append(band)
+
+    runs = []
+    for band in bands:
+        if len(band) < 2:
+            continue
+
+        # back in date order, newest first
+        band.sort()
+        cadences = [
+            get_cadence(ordinals[prev] - ordinals[curr], days[prev],
+                        num_days[prev], days[curr], day_flex)
+            if abs(amounts[curr] - amounts[prev]) <= amount_flex else -1
+            for prev, curr in zip(band, band[1:])
+            ]
+
+        # the histogram of the cadences gives the period of the band,
+        # the shorter cadence wins a tie
+        histogram = [0] * len(SUBS_CADENCES)
+        for cadence in cadences:
+            if cadence >= 0:
+                histogram[cadence] += 1
+        period = max(range(len(histogram)), key=lambda c: (histogram[c], -c))
+        if not histogram[period]:
+            continue
+        period_share = histogram[period] / len(cadences)
+
+        run = []
+        for k, cadence in enumerate(cadences + [-1]):
+            if cadence == period:
+                if not run:
+                    run = [band[k]]
+                run.append(band[k + 1])
+
+            elif run:
+                confidence = period_share * min(
+                    1, (len(run) - 1) / SUBS_CONFIDENT_GAPS)
+                if confidence >= SUBS_MIN_CONFIDENCE:
+                    runs.append((run, period, confidence))
+                run = []
+
+    # oldest stream first, so every stream can be joined to the older
+    # stream it continues
+    runs.sort(key=lambda stream: stream[0][0], reverse=True)
+    streams = []
+    for run, period, confidence in runs:
+        for k, (older_run, older_period, older_confidence) in enumerate(
+                streams):
+            if older_period != period or run[-1] >= older_run[0]:
+                continue
+
+            first, last = run[-1], older_run[0]
+            if get_cadence(ordinals[first] - ordinals[last], days[first],
+                           num_days[first], days[last], day_flex) == period:
+                # the confidence of the joined stream is weighted by the
+                # number of transactions of both
+                streams[k] = (run + older_run, period,
+                              (confidence * len(run) + older_confidence *
+                               len(older_run)) / (len(run) + len(older_run)))
+                break
+        else:
+            streams.append((run, period, confidence))
+
+    # newest stream first
+    streams.sort(key=lambda stream: stream[0][0])
+    return [(run, SUBS_CADENCES[period][0], round(confidence, 2))
+            for run, period, confidence in streams]
+
+
+def get_price_changes(dates, amounts, run):
+    """
+    Find the payments of a subscription stream (indices newest first)
+    whose amount differs from the payment before
+    Returns: list of dictionaries, oldest change first
+    """
+    oldest_first = run[::-1]
+    amount_diffs = [amounts[curr] - amounts[prev]
+                    for prev, curr in zip(oldest_first, oldest_first[1:])]
+
+    price_changes = []
+    for k, amount_diff in enumerate(amount_diffs):
+        if amount_diff:
+            old_amount = amounts[oldest_first[k]]
+            new_amount = amounts[oldest_first[k + 1]]
+            # the change of the price paid, whatever the sign of the
+            # amounts
+            percent_change = round(
+                100 * (abs(new_amount) - abs(old_amount)) / abs(old_amount),
+                1) if old_amount else 0
+            price_changes.append({
+                "change_date": dates[oldest_first[k + 1]],
+                "old_amount": old_amount,
+                "new_amount": new_amount,
+                "percent_change": percent_change
+                })
+
+    return price_changes
+
+
+#################################################################
+# SUBSCRIPTION TIMELINE                                         #
+#################################################################
+def month_index(tx_date):
+    """
+    Return: number of months since year 0 of the month of tx_date
+    """
+    return tx_date.year * 12 + tx_date.month - 1
+
+
+def get_cadence_months(subs_frequency):
+    """
+    Return: number of months one payment of a subscription paid every
+    subs_frequency pays for (less than one for weekly payments)
+    """
+    for name, cadence_days, cadence_months in SUBS_CADENCES:
+        if name == subs_frequency:
+            return cadence_months or cadence_days * 12 / 365
+
+    return 1
+
+
+def get_timeline_headings():
+    """
+    Return the headings of the subscription timeline
+    """
+    keys_list = [
+        "month",
+        "num_active_subs",
+        "committed_monthly_spend",
+        "active_subscriptions"
+        ]
+    return keys_list
+
+
+def build_subscription_timeline(subscriptions_data, start_date, end_date):
+    """
+    Find the subscriptions that were running in every month from
+    start_date to end_date with a sweep over the sorted start and end
+    months of the subscriptions
+    A subscription runs from the month of its first payment until the
+    last month its last payment pays for, or until end_date if it is
+    still active
+    Returns: list of worksheet rows, one per month
+    """
+    first_month = month_index(start_date)
+    last_month = month_index(end_date)
+
+    # (month, 1 for a start or 0 for an end, subscription), so a
+    # subscription ending in a month is removed before the next starts
+    events = []
+    monthly_amounts = []
+    for s, subs in enumerate(subscriptions_data):
+        cadence_months = get_cadence_months(subs["subs_frequency"])
+        monthly_amounts.append(round(subs[TX_AMOUNT_KEY] / cadence_months))
+        if subs["active"]:
+            subs_end = last_month + 1
+        else:
+            subs_end = month_index(subs["subs_end_date"]) + \
+                max(1, round(cadence_months))
+        events.append((month_index(subs["subs_start_date"]), 1, s))
+        events.append((subs_end, 0, s))
+    events.sort()
+
+    running = {}
+    committed_spend = 0
+    timeline = []
+    e = 0
+    for month in range(first_month, last_month + 1):
+        while e < len(events) and events[e][0] <= month:
+            event_month, is_start, s = events[e]
+            if is_start:
+                running[s] = monthly_amounts[s]
+                committed_spend += monthly_amounts[s]
+            else:
+                del running[s]
+                committed_spend -= monthly_amounts[s]
+            e += 1
+
+        names = sorted(subscriptions_data[s][TX_MERCHANT_KEY]
+                       for s in running)
+        timeline.append([
+            f"{month // 12:04d}-{month % 12 + 1:02d}",
+            len(running),
+            from_minor_units(committed_spend),
+            ", ".join(names)
+            ])
+
+    return timeline
+
+
+#################################################################
+# REFUND MATCHING                                               #
+#################################################################
+def match_refunds(sorted_data, max_days):
+    """
+    Match every credit (positive amount) to the latest unmatched charge
+    of the same merchant with the same absolute amount up to max_days
+    before it. The charges are joined through a hash table keyed by the
+    amount per merchant, so every transaction is looked at once
+    Expects: list of dictionaries sorted by merchant and date in
+    reverse order (sorted_clean_data)
+    Returns: list of dictionaries, one per matched refund and the
+    transactions without the matched charges and refunds (same order)
+    """
+    refunds_data = []
+    matched = set()
+    for start, end in merchant_group_bounds(sorted_data):
+        # amount: indices of the unmatched charges, latest last
+        open_charges = {}
+        for i in range(end - 1, start - 1, -1):
+            row = sorted_data[i]
+            if row[TX_AMOUNT_KEY] < 0:
+                open_charges.setdefault(-row[TX_AMOUNT_KEY], []).append(i)
+                continue
+
+            charges = open_charges.get(row[TX_AMOUNT_KEY])
+            if not charges:
+                continue
+
+            charge = sorted_data[charges[-1]]
+            days_to_refund = row[TX_DATE_KEY].toordinal() - \
+                charge[TX_DATE_KEY].toordinal()
+            if days_to_refund > max_days:
+                # all earlier charges of this amount are even older
+                charges.clear()
+                continue
+
+            matched.add(charges.pop())
+            matched.add(i)
+            refunds_data.append({
+                TX_MERCHANT_KEY: row[TX_MERCHANT_KEY],
+                "charge_date": charge[TX_DATE_KEY],
+                "refund_date": row[TX_DATE_KEY],
+                TX_AMOUNT_KEY: row[TX_AMOUNT_KEY],
+                "days_to_refund": days_to_refund
+                })
+
+    remaining_data = [row for i, row in enumerate(sorted_data)
+                      if i not in matched]
+    return refunds_data, remaining_data
+
+
+def get_refunds_headings():
+    """
+    Return the headings of the matched refunds
+    """
+    keys_list = [
+        TX_MERCHANT_KEY,
+        "charge_date",
+        "refund_date",
+        TX_AMOUNT_KEY,
+        "days_to_refund"
+        ]
+    return keys_list
+
+
+def get_refunds_rows(refunds_data):
+    """
+    Convert the matched refunds into worksheet rows
+    """
+    return [
+        [
+            row[TX_MERCHANT_KEY],
+            convert_datetime_object_to_str(row["charge_date"]),
+            convert_datetime_object_to_str(row["refund_date"]),
+            from_minor_units(row[TX_AMOUNT_KEY]),
+            row["days_to_refund"]
+            ]
+        for row in refunds_data
+        ]
+
+
+#################################################################
+# PRICE HISTORY                                                 #
+#################################################################
+def get_price_history_headings():
+    """
+    Return the headings of the price history
+    """
+    keys_list = [
+        TX_MERCHANT_KEY,
+        "subs_frequency",
+        "change_date",
+        "old_amount",
+        "new_amount",
+        "percent_change"
+        ]
+    return keys_list
+
+
+def get_price_history_rows(subscriptions_data):
+    """
+    Collect the price changes of all subscriptions, largest increase
+    first
+    Returns: list of worksheet rows
+    """
+    price_changes = [
+        (subs, change)
+        for subs in subscriptions_data
+        for change in subs["price_changes"]
+        ]
+    price_changes.sort(key=lambda item: item[1]["percent_change"],
+                       reverse=True)
+
+    return [
+        [
+            subs[TX_MERCHANT_KEY],
+            subs["subs_frequency"],
+            convert_datetime_object_to_str(change["change_date"]),
+            from_minor_units(change["old_amount"]),
+            from_minor_units(change["new_amount"]),
+            change["percent_change"]
+            ]
+        for subs, change in price_changes
+        ]
+
+
+#################################################################
+# DUPLICATE CHARGES                                             #
+#################################################################
+def find_duplicate_charges(sorted_data, max_days, amount_flex):
+    """
+    Find charges of the same merchant with the same amount (+-
+    amount_flex in minor units) less than max_days apart. Each
+    merchant's transactions are scanned oldest first with a sliding
+    window of max_days whose left end follows the right end
+    The amounts are put into bands amount_flex + 1 wide and every band
+    keeps a deque of its transactions in the window, so each
+    transaction is only compared with the window transactions of its
+    own band and of the two neighbouring bands (any other band is more
+    than amount_flex away). It is paired with the latest of them within
+    amount_flex. Transactions leaving the window are dropped from the
+    front of their band's deque
+    Expects: list of dictionaries sorted by merchant and date in
+    reverse order (sorted_clean_data)
+    Returns: list of dictionaries, one per flagged pair
+    """
+    band_width = amount_flex + 1
+    duplicates = []
+    for start, end in merchant_group_bounds(sorted_data):
+        merchant_tx = sorted_data[start:end]
+        merchant_tx.reverse()
+        ordinals = [row[TX_DATE_KEY].toordinal() for row in merchant_tx]
+        amounts = [row[TX_AMOUNT_KEY] for row in merchant_tx]
+
+        # band: deque of the indices of its transactions in the window
+        window_bands = {}
+        left = 0
+        for right in range(len(merchant_tx)):
+            while ordinals[right] - ordinals[left] >= max_days:
+                window_bands[amounts[left] // band_width].popleft()
+                left += 1
+
+            band = amounts[right] // band_width
+            match = -1
+            for neighbour in (band - 1, band, band + 1):
+                for k in reversed(window_bands.get(neighbour, ())):
+                    if k <= match:
+                        break
+                    if abs(amounts[right] - amounts[k]) <= amount_flex:
+                        match = k
+                        break
+            window_bands.setdefault(band, deque()).append(right)
+
+            if match >= 0:
+                duplicates.append({
+                    TX_MERCHANT_KEY: merchant_tx[right][TX_MERCHANT_KEY],
+                    "first_tx_date": merchant_tx[match][TX_DATE_KEY],
+                    "second_tx_date": merchant_tx[right][TX_DATE_KEY],
+                    "first_tx_amount": amounts[match],
+                    "second_tx_amount": amounts[right],
+                    "days_apart": ordinals[right] - ordinals[match]
+                    })
+
+    return duplicates
+
+
+def get_duplicates_headings():
+    """
+    Return the headings of the possible double charges
+    """
+    keys_list = [
+        TX_MERCHANT_KEY,
+        "first_tx_date",
+        "second_tx_date",
+        "first_tx_amount",
+        "second_tx_amount",
+        "days_apart",
+        "is_subscription"
+        ]
+    return keys_list
+
+
+def get_duplicates_rows(duplicates, subscriptions_data):
+    """
+    Convert the possible double charges into worksheet rows and mark
+    the ones at merchants with a subscription
+    """
+    subs_merchants = {subs[TX_MERCHANT_KEY] for subs in subscriptions_data}
+    return [
+        [
+            row[TX_MERCHANT_KEY],
+            convert_datetime_object_to_str(row["first_tx_date"]),
+            convert_datetime_object_to_str(row["second_tx_date"]),
+            from_minor_units(row["first_tx_amount"]),
+            from_minor_units(row["second_tx_amount"]),
+            row["days_apart"],
+            str(row[TX_MERCHANT_KEY] in subs_merchants)
+            ]
+        for row in duplicates
+        ]
+
+
+#################################################################
+# FORECAST                                                      #
+#################################################################
+def forecast_charges(subscriptions_data, end_date, num_months):
+    """
+    Project the charges of all active subscriptions into the num_months
+    after end_date. Month based cadences are charged on subs_day,
+    clamped to the end of shorter months, day based cadences every
+    so many days after the last payment
+    Returns: list of dictionaries sorted by date
+    """
+    horizon = subtract_months(end_date, -num_months)
+    horizon_month = month_index(horizon)
+
+    forecast_data = []
+    for subs in subscriptions_data:
+        if not subs["active"]:
+            continue
+
+        for name, cadence_days, cadence_months in SUBS_CADENCES:
+            if name == subs["subs_frequency"]:
+                break
+        else:
+            continue
+
+        last_payment = subs["subs_end_date"]
+        if cadence_months:
+            charge_dates = []
+            for month in range(month_index(last_payment) + cadence_months,
+                               horizon_month + 1, cadence_months):
+                year, month = divmod(month, 12)
+                first_day = datetime(year, month + 1, 1)
+                charge_dates.append(first_day.replace(
+                    day=min(subs["subs_day"], days_in_month(first_day))))
+        else:
+            num_charges = (horizon - last_payment).days // cadence_days
+            charge_dates = [last_payment + timedelta(days=cadence_days * k)
+                            for k in range(1, num_charges + 1)]
+
+        for charge_date in charge_dates:
+            if end_date < charge_date <= horizon:
+                forecast_data.append({
+                    TX_DATE_KEY: charge_date,
+                    TX_MERCHANT_KEY: subs[TX_MERCHANT_KEY],
+                    TX_AMOUNT_KEY: subs[TX_AMOUNT_KEY],
+                    "subs_frequency": subs["subs_frequency"]
+                    })
+
+    forecast_data.sort(key=lambda charge: (charge[TX_DATE_KEY],
+                                           charge[TX_MERCHANT_KEY]))
+    return forecast_data
+
+
+def get_forecast_headings():
+    """
+    Return the headings of the upcoming charges
+    """
+    keys_list = [
+        "month",
+        "num_charges",
+        "projected_total",
+        "charges"
+        ]
+    return keys_list
+
+
+def get_forecast_rows(forecast_data, end_date, num_months):
+    """
+    Convert the forecast into a calendar: one worksheet row per month
+    after end_date with the projected total and the charges by day
+    Returns: list of worksheet rows
+    """
+    first_month = month_index(end_date)
+    months = [[] for month in range(num_months + 1)]
+    for charge in forecast_data:
+        months[month_index(charge[TX_DATE_KEY]) - first_month].append(
+            charge)
+
+    return [
+        [
+            f"{month // 12:04d}-{month % 12 + 1:02d}",
+            len(charges),
+            from_minor_units(sum(charge[TX_AMOUNT_KEY]
+                                 for charge in charges)),
+            ", ".join(f"{charge[TX_DATE_KEY].day:02d} "
+                      f"{charge[TX_MERCHANT_KEY]} "
+                      f"{from_minor_units(charge[TX_AMOUNT_KEY])}"
+                      for charge in charges)
+            ]
+        for month, charges in enumerate(months, first_month)
+        ]
+
+
+#################################################################
+# ROLLING SPEND                                                 #
+#################################################################
+def subtract_months(tx_date, months):
+    """
+    Return: the same day months before tx_date (after it for negative
+    months), clamped to the end of shorter months
+    """
+    year, month = divmod(month_index(tx_date) - months, 12)
+    day = min(tx_date.day, days_in_month(datetime(year, month + 1, 1)))
+    return datetime(year, month + 1, day)
+
+
+class MerchantSpendIndex:
+    """
+    Cumulative sums over the date sorted amounts of every merchant, so
+    the spend of a merchant in any time window is two binary searches
+    and a subtraction
+    Input: list of dictionaries sorted by merchant and date in reverse
+    order (sorted_clean_data)
+    """
+
+    def __init__(self, sorted_data):
+        # merchant: (date ordinals oldest first, cumulative sums with a
+        # leading 0)
+        self.merchants = {}
+        for start, end in merchant_group_bounds(sorted_data):
+            ordinals = array("i")
+            cum_sums = array("q", [0])
+            for row in reversed(sorted_data[start:end]):
+                ordinals.append(row[TX_DATE_KEY].toordinal())
+                cum_sums.append(cum_sums[-1] + row[TX_AMOUNT_KEY])
+            self.merchants[sorted_data[start][TX_MERCHANT_KEY]] = \
+                (ordinals, cum_sums)
+
+    def window_total(self, merchant, start_date, end_date):
+        """
+        Sum up the transactions of merchant from start_date up to but
+        not including end_date
+        Returns: sum in minor units, number of transactions
+        """
+        if merchant not in self.merchants:
+            return 0, 0
+
+        ordinals, cum_sums = self.merchants[merchant]
+        lo = bisect_left(ordinals, start_date.toordinal())
+        hi = bisect_left(ordinals, end_date.toordinal(), lo)
+        return cum_sums[hi] - cum_sums[lo], hi - lo
+
+
+def get_rolling_spend_headings():
+    """
+    Return the headings of the rolling spend per merchant
+    """
+    keys_list = [TX_MERCHANT_KEY]
+    for months in ROLLING_WINDOW_MONTHS:
+        keys_list.append(f"sum_last_{months}_months")
+    keys_list += ["num_tx_last_12_months", "sum_previous_12_months"]
+    return keys_list
+
+
+def get_rolling_spend_rows(spend_index, end_date):
+    """
+    Sum up the spend of every merchant in the ROLLING_WINDOW_MONTHS
+    up to end_date and in the 12 months before the last 12 months for
+    the year-over-year comparison
+    Returns: list of worksheet rows, one per merchant
+    """
+    window_end = end_date + timedelta(days=1)
+    window_starts = [subtract_months(end_date, months) + timedelta(days=1)
+                     for months in ROLLING_WINDOW_MONTHS]
+    year_start = subtract_months(end_date, 12) + timedelta(days=1)
+    previous_year_start = subtract_months(end_date, 24) + timedelta(days=1)
+
+    rows = []
+    for merchant in spend_index.merchants:
+        row = [merchant]
+        for window_start in window_starts:
+            window_sum, num_tx = spend_index.window_total(
+                merchant, window_start, window_end)
+            row.append(from_minor_units(window_sum))
+        year_sum, year_num_tx = spend_index.window_total(
+            merchant, year_start, window_end)
+        previous_year_sum, previous_num_tx = spend_index.window_total(
+            merchant, previous_year_start, year_start)
+        row += [year_num_tx, from_minor_units(previous_year_sum)]
+        rows.append(row)
+
+    return rows
+
+
+#################################################################
+# SPEND PIVOT                                                   #
+#################################################################
+def build_spend_pivot(sorted_data, start_date, end_date):
+    """
+    Sum up the spend of every merchant in every calendar month from
+    start_date to end_date. Every transaction is added in one pass to
+    a flat array of merchants x months at the index of its merchant
+    and month
+    Returns: headings row, list of worksheet rows, one per merchant
+    """
+    first_month = month_index(start_date)
+    num_months = month_index(end_date) - first_month + 1
+    group_bounds = merchant_group_bounds(sorted_data)
+
+    pivot = array("q", [0]) * (len(group_bounds) * num_months)
+    for merchant_id, (start, end) in enumerate(group_bounds):
+        offset = merchant_id * num_months - first_month
+        for row in sorted_data[start:end]:
+            month = month_index(row[TX_DATE_KEY])
+            if first_month <= month < first_month + num_months:
+                pivot[offset + month] += row[TX_AMOUNT_KEY]
+
+    keys_list = [TX_MERCHANT_KEY] + [
+        f"{month // 12:04d}-{month % 12 + 1:02d}"
+        for month in range(first_month, first_month + num_months)
+        ]
+    # months without any spend are left empty
+    rows = [
+        [sorted_data[start][TX_MERCHANT_KEY]] + [
+            from_minor_units(amount) if amount else ""
+            for amount in pivot[merchant_id * num_months:
+                                (merchant_id + 1) * num_months]
+            ]
+        for merchant_id, (start, end) in enumerate(group_bounds)
+        ]
+
+    return keys_list, rows
+
+
+def upload_pivot_to_worksheet(spreadsheet, worksheet_name, tx_data):
+    """
+    create a new worksheet with worksheet_name in spreadsheet and
+    upload the spend per merchant and month as one block in a single
+    write
+    """
+    print("\nStarting the spend per month upload to Google Sheets...")
+
+    try:
+        keys_list, rows = build_spend_pivot(tx_data.sorted_clean_data,
+                                            tx_data.ANALYSIS_START_DATE,
+                                            tx_data.ANALYSIS_END_DATE)
+
+        used_cells = sum(ws.row_count * ws.col_count
+                         for ws in spreadsheet.worksheets())
+        planned_cells = (len(rows) + 1) * len(keys_list)
+        if used_cells + planned_cells > SHEETS_MAX_CELLS:
+            print(f"\nThe spend per month needs {planned_cells} cells but \
+                  \nthe spreadsheet: '{spreadsheet.title}' only has \
+                  \n{SHEETS_MAX_CELLS - used_cells} cells left.")
+            return False
+
+        print("Creating a new worksheet...")
+        ws_output = spreadsheet.add_worksheet(
+            title=worksheet_name, rows=len(rows) + 1, cols=len(keys_list))
+
+        print("Uploading the data...")
+        SHEETS_RATE_LIMITER.wait()
+        ws_output.update([keys_list] + rows, "A1",
+                         value_input_option='USER_ENTERED')
+        last_column = column_number_to_letter(len(keys_list))
+        format_cell_range(ws_output, f"A1:{last_column}1",
+                          CellFormat(textFormat=TextFormat(bold=True)))
+
+        print(f"\nThe spend per month has been uploaded to Spreadsheet: \
+                \n'{spreadsheet.title}' | worksheet: '{worksheet_name}'")
+        return True
+
+    except APIError as e:
+        if e.response.status_code == 400:
+            new_worksheet_name = get_new_worksheet_name(spreadsheet,
+                                                        worksheet_name)
+            # let's call this function recursively to get things done with
+            # a new name for the worksheet
+            return upload_pivot_to_worksheet(spreadsheet,
+                                             new_worksheet_name, tx_data)
+
+        else:
+            print(f"\nAn API error occurred: {e}")
+            print(f"Status Code: {e.response.status_code}")
+            print(f"Error Message: {e.response.text}")
+            return False
+
+    except GSpreadException as e:
+        print(f"\nAn error occurred trying to access the spreadsheet: {e}")
+        return False
+
+
+#################################################################
+# CLASS TxData                                                  #
+#################################################################
+class TxData:
+    """
+    Class to handle all aspects of the transaction data incl:
+    clean_up and analysis
+    Input: list of dictionaries: selected_raw_tx_data
+    All analysis state lives in the instance, so several analyses can
+    run at the same time in one process (e.g. one per thread)
+    Optional: as_of_date the analysis is evaluated at (default: date of
+    the last transaction), subs_day_flex and subs_amount_flex
+    """
+
+    def __init__(self, as_of_date=None, subs_day_flex=SUBS_DAY_FLEX,
+                 subs_amount_flex=SUBS_AMOUNT_FLEX):
+        # we need some settings for the date format as this
+        # seems to be quite messy
+        self.DATE_FORMAT_DAY_FIRST = True
+        self.as_of_date = as_of_date
+        self.ANALYSIS_START_DATE = datetime(2000, 1, 1)
+        self.ANALYSIS_END_DATE = as_of_date or datetime.today()
+        self.subs_day_flex = subs_day_flex
+        self.subs_amount_flex = subs_amount_flex
+        # the amounts are compared in minor units
+        self.subs_amount_flex_minor = to_minor_units(subs_amount_flex)
+
+        self.sorted_clean_data = []
+        self.clean_tx_data = []
+        self.validation_report = ValidationReport()
+        self.subscriptions_data = []
+        self.recurring_merchants_data = []
+        # every raw merchant string is normalized only once
+        # (raw string: normalized name) and every normalized name is
+        # stored only once (name: merchant id, in order of appearance,
+        # see update_merchant_ids)
+        self.merchant_memo = {}
+        self.merchant_ids = {}
+        # set to a CategoryClassifier to tag the results with categories
+        self.category_classifier = None
+        # MerchantSpendIndex of sorted_clean_data for time window queries
+        self.spend_index = None
+        # refunds matched to their charges by match_refunds()
+        self.refunds_data = []
+        # upcoming charges projected by forecast_charges()
+        self.forecast_data = []
+        # hashes of the rows the analysis starts from and of its result
+        # (see get_source_hash and get_result_hash)
+        self.source_hash = None
+        self.result_hash = None
+
+    def check_date_format(self, data):
+        """
+        Check the date format manually as parser.parse is trying convert
+        the date and if the month value is to high because it is a day
+        then it just switches and takes the smaler value as the month
+        Sets the attribute DATE_FORMAT_DAY_FIRST to True or False
+        """
+        print("\nChecking the date format of the input data...\n")
+
+        for row in data:
+            date_str = row[TX_DATE_KEY]
+
+            try:
+                # let's check if we can deconstruct the date string
+                # Regular expression to match dates with '.', '/', or
+                # '-' provided by ChatGPT
                 match = re.match(r'(\d{1,2})[./-](\d{1,2})[./-](\d{4})',
                                  date_str)
 
@@ -909,7 +3702,7 @@ class TxData:
 
                 if month > 12 and month <= 31:
                     # seems the date format is not day first but
-                    # month first, so let's # set the class constant
+                    # month first, so let's set the attribute
                     # and exit
                     self.DATE_FORMAT_DAY_FIRST = False
                     print("\nSWITCHING DATE FORMAT TO MONTH FIRST\n")
@@ -928,9 +3721,10 @@ class TxData:
                 print(type(e))    # the exception type
                 return False
 
-    def clean_date(self, date_str):
+    def clean_date(self, date_str, row=None):
         """
         cleans the date string
+        row: row number, errors are recorded in validation_report
         Return: datetime object, False in case of any error
         """
         # let's deconstruct the date string
@@ -939,7 +3733,7 @@ class TxData:
         match = re.match(r'(\d{1,2})[./-](\d{1,2})[./-](\d{4})', date_str)
 
         if not match:
-            print(f"'{date_str}' is not allowed as date.")
+            self.report_error(row, TX_DATE_KEY, date_str, "invalid_format")
             return False
 
         # Extract day, month, and year from the matched groups provided by
@@ -954,15 +3748,18 @@ class TxData:
             return clean_date
 
         except ValueError:
-            print(f"'{date_str}' is not allowed as date.")
+            self.report_error(row, TX_DATE_KEY, date_str, "invalid_date")
             return False
 
-    def clean_amount(self, amount_str):
+    def clean_amount(self, amount_str, row=None):
         """
         cleans the amount string
-        Return: float, False in case of any error
+        row: row number, errors are recorded in validation_report
+        Return: integer amount in minor units (see CURRENCY_EXPONENT),
+        False in case of any error
         """
         # provided by ChatGPT
+        raw_amount_str = amount_str
 
         try:
             # Remove spaces
@@ -985,44 +3782,81 @@ class TxData:
             elif ',' in amount_str:
                 amount_str = amount_str.replace(',', '.')
 
-            # Convert the cleaned string to float
-            clean_amount = float(amount_str)
+            # Convert the cleaned string straight into minor units, no
+            # float in between
+            clean_amount = Decimal(amount_str)
+            if not clean_amount.is_finite():
+                raise ValueError(amount_str)
+            clean_amount = to_minor_units(clean_amount)
+
+            if clean_amount == 0:
+                self.report_error(row, TX_AMOUNT_KEY, raw_amount_str,
+                                  "zero_amount")
+                return False
 
             return clean_amount
 
-        except ValueError:
-            print(f"'{amount_str}' is not allowed as amount.")
+        except (ValueError, InvalidOperation):
+            self.report_error(row, TX_AMOUNT_KEY, raw_amount_str,
+                              "invalid_amount")
             return False
 
         except Exception as e:
-            print(f"\nUnexpected  error occurred: \n")
             # from https://docs.python.org/3/tutorial/errors.html:
-            print(type(e))    # the exception type
+            self.report_error(row, TX_AMOUNT_KEY, raw_amount_str,
+                              type(e).__name__)
             return False
 
-    def clean_merchant(self, merchant_str):
+    def clean_merchant(self, merchant_str, row=None):
         """
-        cleans the merchant string
+        cleans the merchant string, see normalize_merchant(). Equal
+        names are returned as the same (interned) string object
+        row: row number, errors are recorded in validation_report
         Return: clean string, False in case of any error
         """
         try:
-            clean_merchant = merchant_str.strip()
-            clean_merchant = clean_merchant.lower()
-            clean_merchant = clean_merchant.split(",")[0]
-            clean_merchant = clean_merchant.split(";")[0]
+            clean_merchant = self.merchant_memo.get(merchant_str)
+            if clean_merchant is None:
+                clean_merchant = normalize_merchant(merchant_str)
+                if clean_merchant:
+                    clean_merchant = sys.intern(clean_merchant)
+                    self.merchant_ids.setdefault(clean_merchant,
+                                                 len(self.merchant_ids))
+                self.merchant_memo[merchant_str] = clean_merchant
+
+            if not clean_merchant:
+                self.report_error(row, TX_MERCHANT_KEY, merchant_str,
+                                  "empty_merchant")
+                return False
 
             return clean_merchant
 
-        except ValueError:
-            print(f"'{merchant_str}' is not allowed as Merchant.")
-            return False
-
         except Exception as e:
-            print(f"\nUnexpected  error occurred: \n")
             # from https://docs.python.org/3/tutorial/errors.html:
-            print(type(e))    # the exception type
+            self.report_error(row, TX_MERCHANT_KEY, merchant_str,
+                              type(e).__name__)
             return False
 
+    def update_merchant_ids(self):
+        """
+        Rebuild merchant_ids from clean_tx_data, e.g. after merchant
+        clustering renamed merchants or the data was reloaded from a
+        binary file. Names keep their id in order of appearance
+        Sets attribute merchant_ids
+        """
+        merchant_ids = {}
+        for row in self.clean_tx_data:
+            merchant_ids.setdefault(row[TX_MERCHANT_KEY], len(merchant_ids))
+        self.merchant_ids = merchant_ids
+
+    def report_error(self, row, column, raw_value, error_class):
+        """
+        Record a rejected value in validation_report. Values cleaned
+        outside of clean_up_tx_data (row is None) are not recorded
+        """
+        if row is not None:
+            self.validation_report.add(row, column, raw_value, error_class)
+
     def sort_data(self, data, mode):
         """
         Sort the transaction data
@@ -1055,20 +3889,25 @@ class TxData:
         """
         convert_error_count = 0
         clean_tx_data = []
+        # the rejected values are collected here and reported once
+        self.validation_report = ValidationReport()
 
         num_rows = len(selected_raw_tx_data)-1
         for i in range(num_rows):
             # let's check if we are within the error tolerance
             if convert_error_count >= num_rows * ERROR_TOLERANCE:
+                self.validation_report.print_summary(num_rows)
                 m = f"\nMore than {ERROR_TOLERANCE*100}% errors in the data.\
                         \nPlease check the data and try again.\n"
                 cprint(m, 'red')
                 return False
 
             try:
+                raw_row = selected_raw_tx_data[i][ROW_KEY]
+
                 # clean up the date
                 date_str = selected_raw_tx_data[i][TX_DATE_KEY]
-                clean_date = self.clean_date(date_str)
+                clean_date = self.clean_date(date_str, raw_row)
                 if not clean_date:
                     convert_error_count += 1
                     # cannot have wrong data in dates so let's
@@ -1077,7 +3916,7 @@ class TxData:
 
                 # clean up the amount
                 amount_str = selected_raw_tx_data[i][TX_AMOUNT_KEY]
-                clean_amount = self.clean_amount(amount_str)
+                clean_amount = self.clean_amount(amount_str, raw_row)
                 if not clean_amount:
                     convert_error_count += 1
                     # cannot have wrong data in amount so let's
@@ -1086,7 +3925,7 @@ class TxData:
 
                 # clean up the merchant
                 merchant_str = selected_raw_tx_data[i][TX_MERCHANT_KEY]
-                clean_merchant = self.clean_merchant(merchant_str)
+                clean_merchant = self.clean_merchant(merchant_str, raw_row)
                 if not clean_merchant:
                     convert_error_count += 1
                     # cannot have wrong data in Merchant so let's
@@ -1110,371 +3949,172 @@ class TxData:
                 print(type(e))    # the exception type
                 return False
 
+        self.validation_report.print_summary(num_rows)
         return clean_tx_data
 
+    def load_sorted_from_store(self, store, account):
+        """
+        Read the transaction data of account from the transaction store
+        already grouped by merchant and in reverse date order, as
+        analyze_data expects it. The ordering comes straight from the
+        primary key, so no sorting in Python is needed. Merchants are
+        ordered by their id in the store instead of by name
+        Return: list of dictionaries, False in case of any error
+        """
+        try:
+            store_rows = store.execute(
+                """SELECT t.row, t.tx_date, m.name, t.amount_cents
+                   FROM transactions t
+                   JOIN merchants m ON m.merchant_id = t.merchant_id
+                   WHERE t.account = ?
+                   ORDER BY t.merchant_id DESC, t.tx_date DESC""",
+                (account,))
+            return store_rows_to_tx_data(store_rows)
+
+        except sqlite3.Error as e:
+            print(f"\nRET couldn't read the transaction store: {e}")
+            return False
+
     def get_analysis_time_frame(self, dataset):
         """
         Finds the date of the first and last transaction in the data set
-        Sets class attribute ANALYSIS_START_DATE and ANALYSIS_END_DATE
+        Sets attribute ANALYSIS_START_DATE and ANALYSIS_END_DATE. An
+        explicit as_of_date is kept as ANALYSIS_END_DATE
         """
         sorted_dataset = self.sort_data(dataset, "date")
-        dlen = len(self.clean_tx_data)-1
-        self.ANALYSIS_END_DATE = sorted_dataset[dlen][TX_DATE_KEY]
+        self.ANALYSIS_END_DATE = self.as_of_date or \
+            sorted_dataset[-1][TX_DATE_KEY]
         self.ANALYSIS_START_DATE = sorted_dataset[0][TX_DATE_KEY]
 
-    def merchant_in_list(self, data_list, tx_merchant):
-        """
-        checks the subscription_data list to see if we already have
-        an entry for this merchant. As the list works like a stack
-        with LIFO and given the base list ist sorted by merchant,
-        the last enry is the only relevant so we can use pop method
-        to check
-        Returns:
-          'True' if merchant is not in the list + -1
-          'False'if merchant is in the list + index of tx_merchant
-          in list
-        """
-
-        try:
-            tx_merchant_index = len(data_list)-1
-
-            # let's check if the data_list is empty
-            if tx_merchant_index >= 0:
-                # inspiration:
-                # https://docs.python.org/3/tutorial/datastructures.html
-                # 5.1.1.
-                last_entry_in_list = data_list[-1]
-                last_merchant_in_list = last_entry_in_list[TX_MERCHANT_KEY]
-
-                if last_merchant_in_list == tx_merchant:
-                    # let's tell the calling method that we found it and what
-                    # index is the last
-                    return True, tx_merchant_index
-                else:
-                    return False, -1
-            else:
-                return False, -1
-
-        except Exception as e:
-            print(f"\nUnexpected  error occurred in merchant_in_list: \n")
-            # from https://docs.python.org/3/tutorial/errors.html:
-            print(type(e))    # the exception type
-            return False, -1
-
-    def is_subscription(self, curr_tx_date, prev_tx_date, curr_tx_amount,
-                        prev_tx_amount):
+    def analyze_merchant_group(self, merchant_tx):
         """
-        checks if the recurring transaction at a merchant is to be
-        considered a subscription. Subscriptions happen on or close
-        to the same day +- SUBS_DAY_FLEX AND the amount is +-
-        SUBS_AMOUNT_FLEX the same
-
-        Returns:
-        True: if it is a subscription
-        False: if it is a another purchase at the same merchant
+        Analyze the transactions of a single merchant
+        Expects the merchant's transactions sorted by date in reverse order
+        Every subscription stream found by find_subscription_runs() is
+        appended to subscriptions_data. If at least two of the other
+        transactions are left, the merchant is appended to
+        recurring_merchants_data
+        Both keep the (date, amount) of the transactions they were built
+        from under "transactions", newest first, for the drill-down
         """
-        subs_frequency = ""
-
-        try:
-            # let's make sure we stay in the same months when comparing
-            # the dates from:
-            # https://www.askpython.com/python/examples/find-number-of-days-in-month
-            prev_day = prev_tx_date.day
-            num_days = calendar.monthrange(prev_tx_date.year,
-                                           prev_tx_date.month)[1]
-
-            if prev_day - SUBS_DAY_FLEX <= 0:
-                prev_day = 1
-            elif prev_day + SUBS_DAY_FLEX >= num_days:
-                prev_day = num_days
-
-            amount_within_flex = \
-                (curr_tx_amount >= prev_tx_amount - SUBS_AMOUNT_FLEX) and \
-                (curr_tx_amount <= prev_tx_amount + SUBS_AMOUNT_FLEX)
-
-            day_within_flex = \
-                (curr_tx_date.day >= prev_day - SUBS_DAY_FLEX) and \
-                (curr_tx_date.day <= prev_day + SUBS_DAY_FLEX)
-
-            if amount_within_flex and day_within_flex:
-                days_between_tx = prev_tx_date - curr_tx_date
-                monthly_within_flex = \
-                    (days_between_tx.days >= 30 - SUBS_DAY_FLEX) and \
-                    (days_between_tx.days <= 30 + SUBS_DAY_FLEX)
-
-                quarterly_within_flex = \
-                    (days_between_tx.days >= 91 - SUBS_DAY_FLEX) and \
-                    (days_between_tx.days <= 91 + SUBS_DAY_FLEX)
-
-                yearly_within_flex = \
-                    (days_between_tx.days >= 365 - SUBS_DAY_FLEX) and \
-                    (days_between_tx.days <= 365 + SUBS_DAY_FLEX)
-
-                if monthly_within_flex:
-                    subs_frequency = "monthly"
-
-                elif quarterly_within_flex:
-                    subs_frequency = "quartely"
-
-                elif yearly_within_flex:
-                    subs_frequency = "yearly"
-
-                return True, subs_frequency
-            else:
-                return False, subs_frequency
-
-        except Exception as e:
-            print(f"\nUnexpected  error occurred in merchant_not_in_list: \n")
-            # from https://docs.python.org/3/tutorial/errors.html:
-            print(type(e))    # the exception type
-            return False, -1
-
-    def is_subs_active(self, sub_end_date):
+        merchant = merchant_tx[0][TX_MERCHANT_KEY]
+        dates = [row[TX_DATE_KEY] for row in merchant_tx]
+        amounts = [row[TX_AMOUNT_KEY] for row in merchant_tx]
+        days = [tx_date.day for tx_date in dates]
+        num_days = [days_in_month(tx_date) for tx_date in dates]
+        ordinals = [tx_date.toordinal() for tx_date in dates]
+        amount_order = sorted(range(len(merchant_tx)),
+                              key=amounts.__getitem__)
+
+        runs = find_subscription_runs(
+            days, num_days, ordinals, amounts, amount_order, 0,
+            len(merchant_tx), self.subs_day_flex,
+            self.subs_amount_flex_minor)
+
+        in_subscription = [False] * len(merchant_tx)
+        for run, subs_frequency, confidence in runs:
+            for i in run:
+                in_subscription[i] = True
+
+            # EUREKA we have ourselves a subscritpion
+            self.subscriptions_data.append({
+                TX_MERCHANT_KEY: merchant,
+                # the day of the month of the first payment
+                "subs_day": days[run[-1]],
+                # the last amount paid
+                TX_AMOUNT_KEY: amounts[run[0]],
+                "subs_start_date": dates[run[-1]],
+                "subs_end_date": dates[run[0]],
+                "subs_frequency": subs_frequency,
+                "confidence": confidence,
+                "subs_merchant_sum": sum(amounts[i] for i in run),
+                "num_subs_tx": len(run),
+                "price_changes": get_price_changes(dates, amounts, run),
+                # let's check if the subscription was active at
+                # the end of the period of the dataset
+                "active": is_subs_active(dates[run[0]],
+                                         self.ANALYSIS_END_DATE,
+                                         subs_frequency),
+                "transactions": [(dates[i], amounts[i]) for i in run]
+                })
+
+        # the merchant is recurring but not on the same/simlar day and
+        # the amounts are not the same/similar
+        other_tx = [i for i in range(len(merchant_tx))
+                    if not in_subscription[i]]
+        if len(other_tx) >= 2:
+            self.recurring_merchants_data.append({
+                TX_MERCHANT_KEY: merchant,
+                "last_tx_date": dates[other_tx[0]],
+                "first_tx_date": dates[other_tx[-1]],
+                "last_tx_amount": amounts[other_tx[0]],
+                "merchant_sum": sum(amounts[i] for i in other_tx),
+                "num_tx": len(other_tx),
+                "transactions": [(dates[i], amounts[i]) for i in other_tx]
+                })
+
+    def build_sweep_deltas(self):
         """
-        check if the current subs is active or ended in the past
-        returns: true or false
+        Precompute the columns find_subscription_runs() needs for every
+        transaction, so the parameter sweep can evaluate any
+        SUBS_DAY_FLEX / SUBS_AMOUNT_FLEX setting without touching the
+        transaction data again
+        Uses: self.sorted_clean_data as dataset
+        Returns: dictionary of arrays
         """
-        try:
-            if sub_end_date.day > self.ANALYSIS_END_DATE.day:
-                # if the sub_end_date day is later in the month than the
-                # ANALYSIS_END_DATE need to check if the subs tx
-                # happened last month
-                if sub_end_date.month == self.ANALYSIS_END_DATE.month - 1:
-                    return True
-                else:
-                    return False
-
-            elif sub_end_date.day <= self.ANALYSIS_END_DATE.day:
-                # ok if the subs was active it should have happened on or
-                # before the ANALYSIS_END_DATE
-                if sub_end_date.month == self.ANALYSIS_END_DATE.month:
-                    return True
-                else:
-                    return False
-
-        except Exception as e:
-            print(f"\nUnexpected  error occurred in is_subs_active: \n")
-            # from https://docs.python.org/3/tutorial/errors.html:
-            print(type(e))    # the exception type
-            return
+        deltas = {
+            # per merchant: index of its first transaction
+            "group_starts": array("i"),
+            # per transaction
+            "days": array("i"),
+            "num_days": array("i"),
+            "ordinals": array("i"),
+            "amounts": array("q"),
+            # indices of each merchant's transactions sorted by amount
+            "amount_order": array("i"),
+            # the subscriptions are checked for activity at this date
+            "end_ordinal": array("i", [self.ANALYSIS_END_DATE.toordinal()])
+            }
+
+        for start, end in merchant_group_bounds(self.sorted_clean_data):
+            deltas["group_starts"].append(start)
+            for row in self.sorted_clean_data[start:end]:
+                tx_date = row[TX_DATE_KEY]
+                deltas["days"].append(tx_date.day)
+                deltas["num_days"].append(days_in_month(tx_date))
+                deltas["ordinals"].append(tx_date.toordinal())
+                deltas["amounts"].append(row[TX_AMOUNT_KEY])
+            deltas["amount_order"].extend(sorted(
+                range(start, end), key=deltas["amounts"].__getitem__))
+
+        deltas["group_starts"].append(len(self.sorted_clean_data))
+
+        return deltas
 
     def analyze_data(self):
         """
-        Analyze the transaction data
+        Analyze the transaction data merchant by merchant
         Expects sorted list by merchant and date in reverse order
         Uses: self.sorted_clean_data as dataset
+        Large datasets are analyzed in parallel (see analyze_data_parallel)
         Returns: list of dictionaries subscription_data
         """
         try:
-            new_subs_list_entry = []
-
-            # setting the baseline for the first loop. These values will be
-            # updated as we go through the list and are working backwards
-            # in time:
-            prev_tx_merchant = self.sorted_clean_data[0][TX_MERCHANT_KEY]
-            prev_tx_date = self.sorted_clean_data[0][TX_DATE_KEY]
-            prev_tx_amount = round(self.sorted_clean_data[0][TX_AMOUNT_KEY], 2)
-            total_sum = round(self.sorted_clean_data[0][TX_AMOUNT_KEY], 2)
-            merchant_sum = round(self.sorted_clean_data[0][TX_AMOUNT_KEY], 2)
-            merchant_last_amount_paid = round(self.sorted_clean_data[0]
-                                              [TX_AMOUNT_KEY], 2)
-
-            subs_active = False
-            num_merchant_tx = 1
-
-            for i in range(1, len(self.sorted_clean_data)-1):
-                # let's make this loop as easy readable as possible by setting
-                # readable var names
-                curr_tx_merchant = self.sorted_clean_data[i][TX_MERCHANT_KEY]
-                curr_tx_date = self.sorted_clean_data[i][TX_DATE_KEY]
-                curr_tx_amount = self.sorted_clean_data[i][TX_AMOUNT_KEY]
-
-                total_sum += curr_tx_amount
-
-                # check if it is still the same merchant
-                if prev_tx_merchant.lower() == curr_tx_merchant.lower():
-                    # let's count how many times we shopped at that merchant
-                    merchant_sum += curr_tx_amount
-                    # updating the total sum for this merchant
-                    num_merchant_tx += 1
-
-                    if i == 41:
-                        print("23")
-
-                    # let's check if this merchant already exists in the
-                    # subscription_data list
-                    merchant_in_subs, x = self.merchant_in_list(
-                        self.subscriptions_data, curr_tx_merchant)
-
-                    is_tx_subscription, subs_frequency = self.is_subscription(
-                        curr_tx_date, prev_tx_date, curr_tx_amount,
-                        prev_tx_amount)
-                    if is_tx_subscription:
-                        # EUREKA we have ourselves a subscritpion
-
-                        if not merchant_in_subs:
-                            # ok, it's a subscription but we do not have
-                            # the merchant in the subs list yet, so
-                            # let's build a new entry to the subscriptions_data
-                            # list
-
-                            # let's check if the subscription was active at
-                            # the end of the period of the dataset
-                            subs_active = self.is_subs_active(prev_tx_date)
-
-                            new_subs_list_entry = {
-                                TX_MERCHANT_KEY: curr_tx_merchant,
-                                # subscriptions should happen around
-                                # same day so let's save curent tx
-                                # date and update further as we work
-                                # backwords in time
-                                "subs_day": curr_tx_date.day,
-                                # as the entries in the list get older
-                                # this is the last amount paid and will
-                                # not get updated
-                                TX_AMOUNT_KEY: merchant_last_amount_paid,
-                                # will be updated further as we work
-                                # backwords in time
-                                "subs_start_date": curr_tx_date,
-                                # as this is the second pass at this merchant
-                                # we need to take the previous tx_date as
-                                # last date
-                                "subs_end_date": prev_tx_date,
-                                "subs_frequency": subs_frequency,
-                                "subs_merchant_sum": merchant_sum,
-                                "num_subs_tx": num_merchant_tx,
-                                "active": subs_active
-                                }
-                            # let's add the merchant to the list
-                            self.subscriptions_data.append(new_subs_list_entry)
-
-                        else:
-                            # merchant has already been saved to the list
-                            # previously, so let's update the appropriate
-                            # dictionary entry in the list with the new
-                            # values. As the tx_dates get older let's
-                            # update the start_date to what we know
-                            # in this loop
-                            self.subscriptions_data[x]["subs_start_date"] = \
-                                curr_tx_date
-                            # update further as we work backwords in time
-                            self.subscriptions_data[x]["subs_day"] = \
-                                curr_tx_date.day
-                            self.subscriptions_data[x]["subs_merchant_sum"] = \
-                                merchant_sum
-                            self.subscriptions_data[x]["subs_frequency"] = \
-                                subs_frequency
-                            self.subscriptions_data[x]["num_subs_tx"] = \
-                                num_merchant_tx
+            # start from empty lists so the analysis can be re-run
+            self.subscriptions_data = []
+            self.recurring_merchants_data = []
 
-                    else:
-                        if merchant_in_subs:
-                            # ok this merchant is in subscriptions but
-                            # the subscription amount has changed more
-                            # then SUBS_AMOUNT_FLEX allows let's treat
-                            # this as a new subscription and make a
-                            # new entry in the list
-
-                            # restartiung the  total sum for this new
-                            # subscription at the merchant
-                            merchant_sum = curr_tx_amount
-
-                            # let's restart the count how many times
-                            # we shopped at that merchant
-                            num_merchant_tx = 1
-
-                            new_subs_list_entry = {
-                                TX_MERCHANT_KEY: curr_tx_merchant,
-                                # subscriptions should happen around the
-                                # same day so let's save curent tx date
-                                # and update further as we work backwords
-                                # in time
-                                "subs_day": curr_tx_date.day,
-                                # as the entries in the list get older
-                                # this is the last amount paid and will
-                                # not get updated
-                                TX_AMOUNT_KEY: curr_tx_amount,
-                                # will be updated further as we work
-                                # backwords in time
-                                "subs_start_date": curr_tx_date,
-                                # when this entry is created we set the
-                                # current date as the end-date as we go
-                                # back in time through the list this will
-                                # not be updated
-                                "subs_end_date": curr_tx_date,
-                                "subs_frequency": subs_frequency,
-                                "subs_merchant_sum": merchant_sum,
-                                "num_subs_tx": num_merchant_tx,
-                                # as we only end up here if the subscription
-                                # has changed and since we are going back in
-                                # time the sub cannot be active
-                                "active": False
-                                    }
-                            # let's add the merchant to the list
-                            self.subscriptions_data.append(new_subs_list_entry)
-
-                        else:
-                            # if it is not a subscription and the current
-                            # merchant is not in the subscription_data
-                            # list then the merchant is recurring but
-                            # not on the same/simlar day and the
-                            # amounts are not the same/similar
-
-                            # let's check if this merchant already
-                            # exists in the recurring_merchant list
-                            merchant_in_rec, ri = self.merchant_in_list(
-                                self.recurring_merchants_data,
-                                curr_tx_merchant)
-                            if not merchant_in_rec:
-                                # build a new entry to the subscriptions_data
-                                # list
-                                new_merchands_list_entry = {
-                                    TX_MERCHANT_KEY: curr_tx_merchant,
-                                    # as this is the second pass at this
-                                    # merchant we need to take the previous
-                                    # tx_date as last date
-                                    "last_tx_date": prev_tx_date,
-                                    "first_tx_date": curr_tx_date,
-                                    "last_tx_amount":
-                                    merchant_last_amount_paid,
-                                    "merchant_sum": merchant_sum,
-                                    "num_tx": num_merchant_tx
-                                    }
-
-                                # let's add the merchant to the list
-                                self.recurring_merchants_data.append(
-                                    new_merchands_list_entry)
-
-                            else:
-                                # merchant has already been saved to the
-                                # list previously, so let's update the
-                                # appropriate entry in the list with the
-                                # new values as we go back in time.
-                                f_date = "first_tx_date"
-                                self.recurring_merchants_data[ri][f_date] = \
-                                    curr_tx_date
-                                m_sum = "merchant_sum"
-                                self.recurring_merchants_data[ri][m_sum] = \
-                                    merchant_sum
-                                self.recurring_merchants_data[ri]["num_tx"] = \
-                                    num_merchant_tx
+            group_bounds = merchant_group_bounds(self.sorted_clean_data)
 
-                else:
-                    # new merchant
-                    # let's reset the counters
-                    merchant_sum = curr_tx_amount
-                    num_merchant_tx = 1
-                    merchant_last_amount_paid = round(
-                        self.sorted_clean_data[i][TX_AMOUNT_KEY], 2)
-
-                    # let's reset merchant_in_subs as the current murchant
-                    # was in rec
-                    merchant_in_subs = False
-
-                # Let's make the current the previous before the next loop
-                prev_tx_merchant = curr_tx_merchant
-                prev_tx_amount = curr_tx_amount
-                prev_tx_date = curr_tx_date
+            # only worth starting the worker processes for large datasets
+            if not (ANALYSIS_WORKERS > 1 and
+                    len(self.sorted_clean_data) >= ANALYSIS_PARALLEL_MIN_TX
+                    and self.analyze_data_parallel(group_bounds)):
+                for start, end in group_bounds:
+                    self.analyze_merchant_group(
+                        self.sorted_clean_data[start:end])
+
+            self.categorize_results()
 
             return self.subscriptions_data, self.recurring_merchants_data
 
@@ -1484,6 +4124,367 @@ class TxData:
             print(type(e))  # the exception type
             return
 
+    def categorize_results(self):
+        """
+        Add the spending category of the merchant to every row of
+        subscriptions_data and recurring_merchants_data. Each merchant
+        is classified only once
+        """
+        categories = {}
+        for row in self.subscriptions_data + self.recurring_merchants_data:
+            merchant = row[TX_MERCHANT_KEY]
+            if merchant not in categories:
+                categories[merchant] = \
+                    self.category_classifier.classify(merchant) \
+                    if self.category_classifier else CATEGORY_UNKNOWN
+            row["category"] = categories[merchant]
+
+    def analyze_data_parallel(self, group_bounds):
+        """
+        Analyze the transaction data in a pool of worker processes. The
+        merchant groups are split into shards of about the same number
+        of transactions, each shard is sent to a worker as compact arrays
+        and the results are added in shard order, so the result is the
+        same as analyzing the data merchant by merchant
+        Returns: True if successful, False in case of any error
+        """
+        shards = plan_merchant_shards(
+            group_bounds, ANALYSIS_WORKERS * ANALYSIS_SHARDS_PER_WORKER)
+        payloads = [
+            build_shard_payload(self, shard_bounds)
+            for shard_bounds in shards
+            ]
+
+        try:
+            with ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS) as pool:
+                shard_results = list(pool.map(analyze_shard, payloads))
+
+        except (OSError, BrokenProcessPool) as e:
+            print(f"\nRET couldn't analyze the data in parallel: {e}")
+            print("Continuing with a single process...")
+            return False
+
+        for subscriptions_data, recurring_merchants_data in shard_results:
+            self.subscriptions_data.extend(subscriptions_data)
+            self.recurring_merchants_data.extend(recurring_merchants_data)
+
+        return True
+
+
+#################################################################
+# PARALLEL ANALYSIS                                             #
+#################################################################
+def merchant_group_bounds(sorted_data):
+    """
+    Find the consecutive rows of each merchant in data sorted by merchant
+    Return: list of (start, end) index tuples, one per merchant
+    """
+    group_bounds = []
+    start = 0
+    for i in range(1, len(sorted_data)):
+        if sorted_data[i][TX_MERCHANT_KEY] != \
+           sorted_data[i-1][TX_MERCHANT_KEY]:
+            group_bounds.append((start, i))
+            start = i
+
+    if sorted_data:
+        group_bounds.append((start, len(sorted_data)))
+
+    return group_bounds
+
+
+def plan_merchant_shards(group_bounds, num_shards):
+    """
+    Split the merchant groups into num_shards consecutive shards with
+    about the same number of transactions each. A merchant is never
+    split across shards
+    Return: list of lists of (start, end) tuples
+    """
+    if not group_bounds:
+        return []
+
+    total_tx = group_bounds[-1][1]
+    shards = []
+    shard_bounds = []
+    for start, end in group_bounds:
+        shard_bounds.append((start, end))
+        # close the shard once it reaches its share of the transactions
+        if end >= total_tx * (len(shards) + 1) / num_shards:
+            shards.append(shard_bounds)
+            shard_bounds = []
+
+    if shard_bounds:
+        shards.append(shard_bounds)
+
+    return shards
+
+
+def build_shard_payload(tx_data, shard_bounds):
+    """
+    Pack the transactions of a shard into compact arrays for the
+    worker process: one date ordinal and amount per transaction and one
+    name and transaction count per merchant, plus the settings of
+    tx_data the analysis depends on
+    """
+    sorted_data = tx_data.sorted_clean_data
+    first = shard_bounds[0][0]
+    last = shard_bounds[-1][1]
+    shard_rows = sorted_data[first:last]
+
+    return {
+        "end_date": tx_data.ANALYSIS_END_DATE.toordinal(),
+        "day_flex": tx_data.subs_day_flex,
+        "amount_flex": tx_data.subs_amount_flex,
+        "merchants": [sorted_data[start][TX_MERCHANT_KEY]
+                      for start, end in shard_bounds],
+        "group_sizes": array("i", [end - start
+                                   for start, end in shard_bounds]),
+        "dates": array("i", [row[TX_DATE_KEY].toordinal()
+                             for row in shard_rows]),
+        "amounts": array("q", [row[TX_AMOUNT_KEY] for row in shard_rows])
+        }
+
+
+def analyze_shard(payload):
+    """
+    Worker process: analyze all merchants of one shard
+    Return: subscriptions_data, recurring_merchants_data of the shard
+    """
+    shard_tx_data = TxData(datetime.fromordinal(payload["end_date"]),
+                           payload["day_flex"], payload["amount_flex"])
+
+    dates = payload["dates"]
+    amounts = payload["amounts"]
+    start = 0
+    for merchant, group_size in zip(payload["merchants"],
+                                    payload["group_sizes"]):
+        merchant_tx = [
+            {
+                TX_MERCHANT_KEY: merchant,
+                TX_DATE_KEY: datetime.fromordinal(dates[i]),
+                TX_AMOUNT_KEY: amounts[i]
+                }
+            for i in range(start, start + group_size)
+            ]
+        shard_tx_data.analyze_merchant_group(merchant_tx)
+        start += group_size
+
+    return (shard_tx_data.subscriptions_data,
+            shard_tx_data.recurring_merchants_data)
+
+
+#################################################################
+# PARAMETER SWEEP                                               #
+#################################################################
+# precomputed deltas for the sweep worker processes
+sweep_deltas = None
+
+
+def evaluate_sweep_setting(deltas, day_flex, amount_flex):
+    """
+    Count the subscriptions analyze_data would find with day_flex and
+    amount_flex instead of SUBS_DAY_FLEX and SUBS_AMOUNT_FLEX. Uses
+    find_subscription_runs like analyze_merchant_group but only keeps
+    the totals
+    Returns: list with the settings and the totals (in minor units)
+    """
+    amount_flex_minor = to_minor_units(amount_flex)
+    group_starts = deltas["group_starts"]
+    amounts = deltas["amounts"]
+    ordinals = deltas["ordinals"]
+    end_date = datetime.fromordinal(deltas["end_ordinal"][0])
+
+    num_subs = 0
+    num_active = 0
+    active_amount = 0
+    subs_sum = 0
+
+    for g in range(len(group_starts) - 1):
+        runs = find_subscription_runs(
+            deltas["days"], deltas["num_days"], ordinals, amounts,
+            deltas["amount_order"], group_starts[g], group_starts[g+1],
+            day_flex, amount_flex_minor)
+
+        for run, subs_frequency, confidence in runs:
+            num_subs += 1
+            subs_sum += sum(amounts[i] for i in run)
+            if is_subs_active(datetime.fromordinal(ordinals[run[0]]),
+                              end_date, subs_frequency):
+                num_active += 1
+                active_amount += amounts[run[0]]
+
+    return [day_flex, amount_flex, num_subs, num_active, active_amount,
+            subs_sum]
+
+
+def init_sweep_worker(deltas):
+    """
+    Worker process: keep the precomputed deltas for all settings
+    """
+    global sweep_deltas
+    sweep_deltas = deltas
+
+
+def evaluate_sweep_worker(setting):
+    """
+    Worker process: evaluate one (day_flex, amount_flex) setting
+    """
+    return evaluate_sweep_setting(sweep_deltas, *setting)
+
+
+def run_parameter_sweep(tx_data, day_flex_values, amount_flex_values):
+    """
+    Evaluate every combination of day_flex_values and amount_flex_values
+    against the sorted transaction data. The deltas are computed once
+    and the settings are evaluated in parallel
+    Returns: list of result rows, one per setting
+    """
+    print("\nRunning the parameter sweep...")
+    deltas = tx_data.build_sweep_deltas()
+    settings = [(day_flex, amount_flex)
+                for day_flex in day_flex_values
+                for amount_flex in amount_flex_values]
+
+    if ANALYSIS_WORKERS > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS,
+                                     initializer=init_sweep_worker,
+                                     initargs=(deltas,)) as pool:
+                return list(pool.map(evaluate_sweep_worker, settings))
+
+        except (OSError, BrokenProcessPool) as e:
+            print(f"\nRET couldn't run the sweep in parallel: {e}")
+            print("Continuing with a single process...")
+
+    return [evaluate_sweep_setting(deltas, day_flex, amount_flex)
+            for day_flex, amount_flex in settings]
+
+
+def print_sweep_results(sweep_results):
+    """
+    Print the parameter sweep results as a table
+    """
+    print(f"\n{'Day flex:':<10} | "
+          f"{'Amount flex:':<12} | "
+          f"{'Subscriptions:':<14} | "
+          f"{'Active:':<7} | "
+          f"{'Active amount:':<14} | "
+          f"{'Subscriptions sum:':<18}\n")
+
+    for d, a, n, na, aa, s in sweep_results:
+        print(f"{d:<10} | "
+              f"{a:<12} | "
+              f"{n:<14} | "
+              f"{na:<7} | "
+              f"{from_minor_units(aa):<14} | "
+              f"{from_minor_units(s):<18}")
+
+
+def upload_sweep_to_worksheet(spreadsheet, worksheet_name, sweep_results):
+    """
+    create a new worksheet with worksheet_name in spreadsheet and
+    upload the parameter sweep results in a single write
+    """
+    keys_list = [
+        "subs_day_flex",
+        "subs_amount_flex",
+        "num_subscriptions",
+        "num_active",
+        "active_amount",
+        "subs_merchant_sum"
+        ]
+
+    try:
+        ws_output = spreadsheet.add_worksheet(
+            title=worksheet_name, rows=len(sweep_results) + 1,
+            cols=len(keys_list))
+        rows = [[d, a, n, na, from_minor_units(aa), from_minor_units(s)]
+                for d, a, n, na, aa, s in sweep_results]
+        ws_output.update([keys_list] + rows, "A1",
+                         value_input_option='USER_ENTERED')
+        format_row_in_worksheet(ws_output, 1, "bold")
+
+        print(f"\nThe parameter sweep has been uploaded to Spreadsheet: \
+                \n'{spreadsheet.title}' | worksheet: '{worksheet_name}'")
+        return True
+
+    except APIError as e:
+        if e.response.status_code == 400:
+            print(f"\nA worksheet with the name '{worksheet_name}' \
+                  \nalready exists in the spreadsheet: '{spreadsheet.title}'.")
+            new_worksheet_name = input("Please enter a different name \
+                                       \nfor the worksheet:\n")
+            return upload_sweep_to_worksheet(spreadsheet, new_worksheet_name,
+                                             sweep_results)
+
+        else:
+            print(f"\nAn API error occurred: {e}")
+            return False
+
+    except GSpreadException as e:
+        print(f"\nAn error occurred trying to access the spreadsheet: {e}")
+        return False
+
+
+def run_analysis(tx_data, account):
+    """
+    Merge the merchant aliases, store and sort the clean data of
+    account, match the refunds, analyze the data and forecast the
+    upcoming charges. The result is saved in the result cache
+    Sets: the RESULT_CACHE_ATTRIBUTES and result_hash of tx_data
+    """
+    # let's merge the variants of the same merchant before the data is
+    # stored, so the store only ever sees the merged names
+    if MERCHANT_CLUSTERING_ENABLED:
+        num_merged = merge_merchant_aliases(
+            tx_data.clean_tx_data, merchant_alias_file_name(account))
+        if num_merged:
+            print(f"{num_merged} merchant name(s) have been merged \
+                  \ninto a similar merchant name.\n")
+    tx_data.update_merchant_ids()
+
+    # let's keep the cleaned data in the transaction store and read it
+    # back already sorted by merchant and date. If the store isn't
+    # available we sort the cleaned data ourselves
+    store = open_tx_store() if TX_STORE_ENABLED else False
+    if store:
+        if save_tx_data_to_store(store, account,
+                                 tx_data.clean_tx_data) is not False:
+            print("Reading the transaction data from the store...")
+            tx_data.sorted_clean_data = tx_data.load_sorted_from_store(
+                store, account)
+        store.close()
+
+    if not tx_data.sorted_clean_data:
+        print("Sorting the cleaned transaction data...")
+        tx_data.sorted_clean_data = tx_data.sort_data(
+            tx_data.clean_tx_data, "merch_date")
+
+    # finding start and end date of dataset
+    tx_data.get_analysis_time_frame(tx_data.sorted_clean_data)
+
+    # let's take refunds and the charges they refund out of the data, so
+    # they don't distort the subscriptions and totals
+    tx_data.refunds_data, tx_data.sorted_clean_data = match_refunds(
+        tx_data.sorted_clean_data, REFUND_MAX_DAYS)
+    if tx_data.refunds_data:
+        print(f"RET matched {len(tx_data.refunds_data)} refunds to their "
+              "charges.")
+
+    # let's analyze the data and project the active subscriptions into
+    # the next months
+    (tx_data.subscriptions_data,
+        tx_data.recurring_merchants_data) = tx_data.analyze_data()
+    tx_data.forecast_data = forecast_charges(tx_data.subscriptions_data,
+                                             tx_data.ANALYSIS_END_DATE,
+                                             FORECAST_MONTHS)
+
+    # the result is cached with the aliases as they are after this run,
+    # which is how the next run of the same data will find them
+    tx_data.result_hash = get_result_hash(
+        tx_data, load_merchant_aliases(merchant_alias_file_name(account)))
+    save_cached_result(tx_data.result_hash, tx_data)
+
 
 def main():
     """
@@ -1520,6 +4521,12 @@ def main():
 
     clean_console()
 
+    # an interrupted upload is finished from its checkpoint, there is no
+    # need to import and analyze the data again
+    if resume_upload(SHEET):
+        print("Goodbye!")
+        return
+
     # regardless if user created a new sheet or re-used on, we  we are now
     # ready to ask the user to import the CSV file
     RAW_DATA_WSHEET = get_imported_csv_wsheet(SHEET)
@@ -1528,6 +4535,8 @@ def main():
 
     # let's instantiate the class as we need it's methods now
     tx_data = TxData()
+    tx_data.category_classifier = load_category_classifier(
+        CATEGORY_RULES_FILE)
 
     clean_data = check_import_raw_data(RAW_DATA_WSHEET, tx_data)
     if not clean_data:
@@ -1537,16 +4546,44 @@ def main():
 
     clean_console()
 
-    # sort the cleaned data
-    print("Sorting the cleaned transaction data...")
-    tx_data.sorted_clean_data = tx_data.sort_data(tx_data.clean_tx_data,
-                                                  "merch_date")
-
-    # finding start and end date of dataset
-    tx_data.get_analysis_time_frame(tx_data.clean_tx_data)
+    # the result was found in the cache before the data was cleaned,
+    # otherwise let's analyze the clean data now
+    if tx_data.result_hash:
+        print("RET found the results of this data in its cache.")
+    else:
+        run_analysis(tx_data, tx_account_key(RAW_DATA_WSHEET))
+
+    # let's index the spend of every merchant over time once, so any
+    # time window can be summed up without going through the data again
+    tx_data.spend_index = MerchantSpendIndex(tx_data.sorted_clean_data)
+
+    # let's look for charges that might have been billed twice
+    duplicates = find_duplicate_charges(
+        tx_data.sorted_clean_data, DUPLICATE_MAX_DAYS,
+        to_minor_units(DUPLICATE_AMOUNT_FLEX))
+    if duplicates:
+        cprint(f"\nRET found {len(duplicates)} possible double charges.",
+               'light_cyan')
 
-    (tx_data.subscriptions_data,
-        tx_data.recurring_merchants_data) = tx_data.analyze_data()
+    # let's see which subscriptions were running in every month
+    extra_blocks = [
+        ("ACTIVE SUBSCRIPTIONS PER MONTH", get_timeline_headings(),
+         build_subscription_timeline(tx_data.subscriptions_data,
+                                     tx_data.ANALYSIS_START_DATE,
+                                     tx_data.ANALYSIS_END_DATE)),
+        ("ROLLING SPEND PER MERCHANT", get_rolling_spend_headings(),
+         get_rolling_spend_rows(tx_data.spend_index,
+                                tx_data.ANALYSIS_END_DATE)),
+        ("UPCOMING CHARGES", get_forecast_headings(),
+         get_forecast_rows(tx_data.forecast_data, tx_data.ANALYSIS_END_DATE,
+                           FORECAST_MONTHS)),
+        ("POSSIBLE DOUBLE CHARGES", get_duplicates_headings(),
+         get_duplicates_rows(duplicates, tx_data.subscriptions_data)),
+        ("REFUNDS", get_refunds_headings(),
+         get_refunds_rows(tx_data.refunds_data)),
+        ("PRICE HISTORY", get_price_history_headings(),
+         get_price_history_rows(tx_data.subscriptions_data))
+        ]
 
     # upload the analysis result data to a new worksheet
     if not upload_results_to_worksheet(SHEET, "ANALYSIS RESULTS",
@@ -1555,9 +4592,32 @@ def main():
                                        "MERCHANT WITH MULTIPLE PURCHASES",
                                        tx_data.recurring_merchants_data,
                                        tx_data.ANALYSIS_START_DATE,
-                                       tx_data.ANALYSIS_END_DATE):
+                                       tx_data.ANALYSIS_END_DATE,
+                                       extra_blocks, tx_data.result_hash):
         print("\nan error occurred while uploading the data to the \
               \nGoogle Sheet.")
 
-
-main()
+    # let's offer the individual purchases behind the results
+    drilldown = input("\nDo you want a list of the individual purchases at \
+                      \nyour subscriptions and recurring merchants? (y/n):\n")
+    if drilldown.strip().lower() == "y":
+        upload_drilldown_to_worksheet(SHEET, "INDIVIDUAL PURCHASES", tx_data)
+
+    # let's offer the spend of every merchant per month
+    pivot = input("\nDo you want a table of your spend per merchant and \
+                  \nmonth? (y/n):\n")
+    if pivot.strip().lower() == "y":
+        upload_pivot_to_worksheet(SHEET, "SPEND PER MONTH", tx_data)
+
+    # let's offer to compare the results of other detection settings
+    run_sweep = input("\nDo you want to compare the results for other \
+                      \nday and amount flex settings? (y/n):\n")
+    if run_sweep.strip().lower() == "y":
+        sweep_results = run_parameter_sweep(tx_data, SWEEP_DAY_FLEX_VALUES,
+                                            SWEEP_AMOUNT_FLEX_VALUES)
+        print_sweep_results(sweep_results)
+        upload_sweep_to_worksheet(SHEET, "PARAMETER SWEEP", sweep_results)
+
+
+if __name__ == "__main__":
+    main()